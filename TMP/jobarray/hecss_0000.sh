@@ -0,0 +1,5 @@
+#!/bin/sh
+
+cd "/root/package/TMP/jobarray/smpl/$(printf %04d $((${HECSS_TASK_ID} + 0)))" || exit 1
+/root/.pyenv/versions/3.11.7/bin/python3.11 -c "import ase.io; from ase.calculators.emt import EMT; a = ase.io.read('in.xyz'); a.calc = EMT(); a.get_forces(); ase.io.write('out.xyz', a)"
+echo $? > .hecss_done
@@ -0,0 +1,5 @@
+#!/bin/sh
+
+cd "/root/package/TMP/jobarray/smpl/$(printf %04d $((${HECSS_TASK_ID} + 16)))" || exit 1
+false
+echo $? > .hecss_done
@@ -3,18 +3,65 @@
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
 index = {"dfset_writer": "02_CLI.ipynb",
+         "read_xscale_history": "02_CLI.ipynb",
          "hecss_sampler": "02_CLI.ipynb",
          "calculate_xscale": "02_CLI.ipynb",
          "plot_stats": "12_monitor.ipynb",
          "plot_bands": "12_monitor.ipynb",
+         "hecss_monitor": "02_CLI.ipynb",
+         "compare_bands": "12_monitor.ipynb",
+         "chain_stats": "02_CLI.ipynb",
+         "md2dfset": "02_CLI.ipynb",
+         "hecss_rebuild": "02_CLI.ipynb",
+         "dfset_export": "02_CLI.ipynb",
          "write_dfset": "11_core.ipynb",
+         "DFSETIndex": "11_core.ipynb",
+         "write_dfset_meta": "11_core.ipynb",
+         "SampleBank": "11_core.ipynb",
+         "export_dfset": "11_core.ipynb",
+         "StructureContext": "11_core.ipynb",
+         "structure_hash": "11_core.ipynb",
+         "get_structure_context": "11_core.ipynb",
          "calc_init_xscale": "11_core.ipynb",
+         "History": "11_core.ipynb",
+         "AmplitudeCorrection": "11_core.ipynb",
+         "CalcSupervisor": "11_core.ipynb",
+         "Telemetry": "11_core.ipynb",
+         "VirialAccumulator": "11_core.ipynb",
+         "read_alamode_fc2": "11_core.ipynb",
+         "fit_force_constants": "11_core.ipynb",
+         "NormalModeProposal": "11_core.ipynb",
          "HECSS_Sampler": "11_core.ipynb",
+         "model_width": "11_core.ipynb",
+         "fit_width": "11_core.ipynb",
          "HECSS": "11_core.ipynb",
+         "HECSS_Ensemble": "11_core.ipynb",
+         "ASEBatchCalculator": "11_core.ipynb",
+         "HECSS_Batch_Sampler": "11_core.ipynb",
+         "JobArrayScheduler": "11_core.ipynb",
+         "LocalScheduler": "11_core.ipynb",
+         "JobArrayCalculator": "11_core.ipynb",
          "select_asap_model": "11_core.ipynb",
+         "autocorrelation": "11_core.ipynb",
+         "autocorr_time": "11_core.ipynb",
+         "effective_sample_size": "11_core.ipynb",
+         "ConvergenceSentinel": "11_core.ipynb",
+         "SampleBus": "11_core.ipynb",
+         "normalize_confs": "11_core.ipynb",
          "normalize_conf": "11_core.ipynb",
+         "write_dfset_frames": "11_core.ipynb",
+         "iter_trajectory": "11_core.ipynb",
+         "trajectory_to_dfset": "11_core.ipynb",
+         "float32_errors": "11_core.ipynb",
+         "SampleStore": "11_core.ipynb",
+         "read_vasprun_ef": "11_core.ipynb",
+         "read_dfset_sequence": "11_core.ipynb",
+         "rebuild_dfset": "11_core.ipynb",
+         "symmetry_operations": "11_core.ipynb",
+         "augment_sample": "11_core.ipynb",
          "THz": "12_monitor.ipynb",
          "plot_band_set": "12_monitor.ipynb",
+         "load_bands": "12_monitor.ipynb",
          "plot_bands_file": "12_monitor.ipynb",
          "run_alamode": "12_monitor.ipynb",
          "get_dfset_len": "12_monitor.ipynb",
@@ -24,12 +71,22 @@ index = {"dfset_writer": "02_CLI.ipynb",
          "plot_omega": "12_monitor.ipynb",
          "monitor_phonons": "12_monitor.ipynb",
          "load_dfset": "12_monitor.ipynb",
+         "plot_energy_stats": "12_monitor.ipynb",
          "monitor_stats": "12_monitor.ipynb",
+         "DFSETStats": "12_monitor.ipynb",
+         "RunMonitor": "12_monitor.ipynb",
+         "monitor_daemon": "12_monitor.ipynb",
          "moving_average": "12_monitor.ipynb",
          "ewma": "12_monitor.ipynb",
          "plot_hist": "12_monitor.ipynb",
+         "plot_acc_hist": "12_monitor.ipynb",
          "plot_virial_stat": "12_monitor.ipynb",
          "plot_acceptance_history": "12_monitor.ipynb",
+         "chain_ess": "12_monitor.ipynb",
+         "print_ess_report": "12_monitor.ipynb",
+         "plot_autocorr": "12_monitor.ipynb",
+         "load_bands_many": "12_monitor.ipynb",
+         "print_bands_comparison": "12_monitor.ipynb",
          "plot_dofmu_stat": "12_monitor.ipynb",
          "plot_xs_stat": "12_monitor.ipynb"}
 
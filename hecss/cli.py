@@ -7,31 +7,65 @@ __all__ = []
 import click
 from pathlib import Path
 import os
-import ase
-from ase.calculators.vasp import Vasp
-from ase import units as un
-from numpy import savetxt, loadtxt
-from .core import *
+import sys
 import hecss
 
 # Internal Cell
 # exporti
-def dfset_writer(s, sl, workdir='', dfset='', scale='', xsl=None):
+def dfset_writer(s, sl, workdir='', dfset='', scale='', xsl=None, augment='', ops=None, T=None,
+                 dedup=False):
     '''
     Write samples to the DFSET file in the workdir directory.
+    With dedup the repeated (rejected) samples only increase
+    the multiplicity of the last set (see `export_dfset`).
+    If the target temperature T is given, write also the sampling
+    metadata of the sample (used by the `SampleBank`).
     If the scale and xsl list are not empy save amplitude correction
-    and empty the xsl list (!).
+    and remove the saved entries from the xsl list (!). Entries appended
+    in the meantime are kept, thus the writer may run on the `SampleBus`.
+    The `History` in xsl is written as a whole to the scale file
+    every `xsl.every` samples - save it once more at the end of the run.
+    If the augment file name and symmetry operations (ops) are given
+    write the symmetry images of the sample to the augment file.
     '''
+    from numpy import savetxt
+    from .core import write_dfset, write_dfset_frames, write_dfset_meta, augment_sample, History
+
     wd = Path(workdir)
-    write_dfset(f'{wd.joinpath(dfset)}', s)
-    if scale and xsl:
+    write_dfset(f'{wd.joinpath(dfset)}', s, dedup=dedup)
+    if T is not None:
+        write_dfset_meta(wd.joinpath(dfset), s, T)
+    if augment and ops is not None:
+        xs, fs = augment_sample(s, ops)
+        write_dfset_frames(wd.joinpath(augment), xs, fs, [s[-1]]*len(xs),
+                           start=(s[0]-1)*len(xs)+1, configs=[s[1]]*len(xs))
+    if scale and isinstance(xsl, History):
+        if s[0] % xsl.every == 0:
+            xsl.save(wd.joinpath(scale))
+    elif scale and xsl:
+        n = len(xsl)
         with open(wd.joinpath(scale), 'at') as sf:
-            for xs in xsl:
-                savetxt(sf, xs, fmt='%8.5f', header=f'{xs.shape}, {len(sl)}, {len(xsl)}')
-        xsl.clear()
+            for xs in xsl[:n]:
+                savetxt(sf, xs, fmt='%8.5f', header=f'{xs.shape}, {len(sl)}, {n}')
+        del xsl[:n]
     # Important! Return False to keep iteration going
     return False
 
+# Internal Cell
+# exporti
+def read_xscale_history(fn, nat):
+    '''
+    Read the amplitude correction history saved with the `--scale` option:
+    the `History` file or the array of the complete `(nat, 3)` entries.
+    '''
+    from zipfile import is_zipfile
+    from numpy import loadtxt
+    from .core import History
+
+    if is_zipfile(fn):
+        return History.load(fn)
+    return loadtxt(fn).reshape((-1, nat, 3))
+
 # Internal Cell
 # exporti
 _version_message=("HECSS, version %(version)s\n"
@@ -49,16 +83,37 @@ _version_message=("HECSS, version %(version)s\n"
 @click.option('-w', '--width', default=1.0, type=float, help="Initial scale of the prior distribution")
 @click.option('-a', '--ampl', default='', type=click.Path(), help='Initialise amplitude correction from the file.')
 @click.option('-s', '--scale', default='', type=click.Path(), help='Save amplitude correction history')
+@click.option('-H', '--history', default='full', type=click.Choice(['full', 'element', 'dof']),
+              help='Amplitude correction history: complete arrays or per-element/per-DOF means')
+@click.option('--every', default=1, type=int, help='Save the amplitude correction history every N steps')
+@click.option('--snapshot', default=0, type=int,
+              help='Save complete amplitude correction every N steps (with aggregated history)')
 @click.option('-C', '--calc', default="VASP", type=str,
               help="ASE calculator to be used for the job. "
                       "Supported calculators: VASP (default)")
 @click.option('-n', '--nodfset', is_flag=True, help='Do not write DFSET file for ALAMODE')
 @click.option('-d', '--dfset', default='DFSET.dat', help='Name of the DFSET file')
+@click.option('-A', '--augment', default='', help='Write symmetry images of the samples to this DFSET file')
+@click.option('-D', '--dedup', is_flag=True,
+              help='Write repeated samples as multiplicities of the sets (see dfset_export)')
+@click.option('-F', '--fc', default=None, type=click.Path(exists=True),
+              help='Propose displacements in the normal modes of the force constants '
+                   'from the ALAMODE XML file or fitted to the DFSET file of a previous run')
 @click.option('-N', '--nsamples', default=10, type=int, help="Number of samples to be generated")
 @click.option('-c', '--command', default='./run-calc', help="Command to run calculator")
+@click.option('-u', '--until-converged', is_flag=True,
+              help="Stop when the sample is converged. NSAMPLES is the max. number of samples then.")
+@click.option('--min-ess', default=100, type=int, help="Min. effective sample size for --until-converged")
+@click.option('--pvalue', default=0.05, type=float, help="Min. p-value of the KS test for --until-converged")
+@click.option('--vir-tol', default=0.02, type=float, help="Max. relative change of virials for --until-converged")
+@click.option('-t', '--timeout', default=None, type=float, help="Wall-clock limit of one calculation (s)")
+@click.option('-r', '--retries', default=0, type=int, help="Number of retries of the failed calculation")
+@click.option('-q', '--quarantine', is_flag=True, help="Move directories of failed calculations to smpl/failed")
 @click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
 @click.help_option('-h', '--help')
-def hecss_sampler(fname, workdir, label, temp, width, ampl, scale, calc, nodfset, dfset, nsamples, command):
+def hecss_sampler(fname, workdir, label, temp, width, ampl, scale, calc, nodfset, dfset, augment, nsamples, command,
+                  until_converged, min_ess, pvalue, vir_tol, timeout, retries, quarantine,
+                  history, every, snapshot, dedup, fc):
     '''
     Run HECSS sampler on the structure in the provided file (FNAME).\b
     Read the docs at: https://jochym.gitlab.io/hecss/
@@ -68,6 +123,16 @@ def hecss_sampler(fname, workdir, label, temp, width, ampl, scale, calc, nodfset
             directory must be readable by Vasp(restart).
             Usually this is a CONTCAR file for a supercell.
     '''
+    if snapshot and history == 'full' and every == 1:
+        raise click.UsageError('--snapshot needs the aggregated (--history element/dof) '
+                               'or decimated (--every > 1) history')
+
+    import ase
+    from ase.calculators.vasp import Vasp
+    from numpy import loadtxt
+    from .core import HECSS, ConvergenceSentinel, SampleBus, CalcSupervisor, symmetry_operations
+    from .core import History, get_structure_context, DFSETIndex
+    from .core import NormalModeProposal, read_alamode_fc2, fit_force_constants
 
     print(f'HECSS ({hecss.__version__})\n'
           f'Supercell:      {fname}\n'
@@ -88,21 +153,53 @@ def hecss_sampler(fname, workdir, label, temp, width, ampl, scale, calc, nodfset
         print(f'The {calc} calculator is not supported.')
         return
 
-    if nodfset :
-        sentinel = None
-    else :
-        sentinel = dfset_writer
+    # Write the output on the background thread
+    sentinel = SampleBus()
+    if not nodfset :
+        sentinel.register(dfset_writer)
+    bus = sentinel
+
+    if until_converged:
+        sentinel = ConvergenceSentinel(cryst, temp, min_ess=min_ess, pvalue=pvalue,
+                                       vir_tol=vir_tol, sentinel=sentinel, verb=True)
 
     xsl = None
     if scale:
-        xsl = []
+        if history == 'full' and every == 1:
+            xsl = []
+        else :
+            xsl = History(get_structure_context(cryst), mode=history, every=every,
+                          snapshot=snapshot if snapshot else None)
 
     xsi = None
     if ampl:
         xsi = loadtxt(ampl)
 
-    sampler = HECSS(cryst, calculator, temp, directory=workdir, width=width, xscale_init=xsi, xscale_list=xsl)
-    samples = sampler.generate(nsamples, sentinel=sentinel, workdir=workdir, dfset=dfset, scale=scale, xsl=xsl)
+    ops = None
+    if augment:
+        ops = symmetry_operations(cryst)
+
+    proposal = None
+    if fc:
+        if Path(fc).suffix == '.xml':
+            fcm = read_alamode_fc2(fc, cryst)
+        else :
+            fcm = fit_force_constants(DFSETIndex(fc).read(expand=True), get_structure_context(cryst))
+        proposal = NormalModeProposal(fcm, temp)
+
+    supervisor = CalcSupervisor(timeout=timeout, retries=retries, quarantine=quarantine)
+    sampler = HECSS(cryst, calculator, temp, directory=workdir, width=width, xscale_init=xsi, xscale_list=xsl,
+                    supervisor=supervisor, proposal=proposal)
+    with bus:
+        samples = sampler.generate(nsamples, sentinel=sentinel, workdir=workdir, dfset=dfset, scale=scale,
+                                   xsl=xsl, augment=augment, ops=ops, T=temp, dedup=dedup)
+    if scale and isinstance(xsl, History):
+        # The writer saves the history only every few samples
+        xsl.save(Path(workdir).joinpath(scale))
+    st = supervisor.stats
+    if st['failures'] or st['timeouts']:
+        print(f'Calculations: {st["calls"]}  failed: {st["failures"]}  timed out: {st["timeouts"]}'
+              f'  abandoned: {st["abandoned"]}')
     return
 
 # Internal Cell
@@ -119,8 +216,12 @@ def calculate_xscale(supercell, scale, output, skip):
     Calculate initial values for amplitude correction coefficients
     from the scale file data for the specified supercell.
     '''
+    import ase.io
+    from numpy import savetxt, loadtxt
+    from .core import calc_init_xscale
+
     sc = ase.io.read(supercell)
-    xsl = loadtxt(scale).reshape((-1, len(sc), 3))
+    xsl = read_xscale_history(scale, len(sc))
     xsi = calc_init_xscale(sc, xsl, skip=skip if skip else None)
     savetxt(output, xsi, fmt='%9.4f')
 
@@ -142,8 +243,8 @@ def plot_stats( dfset, t, output, x, sixel, sqrn, width, height):
     Use T(K) as a reference target temperature. Optionally
     write out the plot to the output graphics file.
     """
+    import matplotlib.pyplot as plt
     import hecss.monitor as hm
-    import matplotlib.pylab as plt
 
     p = Path(dfset)
 
@@ -179,9 +280,8 @@ def plot_bands( bands, output, x, sixel, width, height, label, nodecor):
     Plot the phonon dispersion from the file generated by ALAMODE.
     Optionally write out the plot to the output graphics file.
     """
+    import matplotlib.pyplot as plt
     import hecss.monitor as hm
-    import matplotlib.pylab as plt
-
 
     plt.figure(figsize=(float(width), float(height)))
 
@@ -208,4 +308,197 @@ def plot_bands( bands, output, x, sixel, width, height, label, nodecor):
         except ImportError:
             print('SixEl graphics support not installed. Install sixelplot package.')
             return
-        sixelplot.show()
\ No newline at end of file
+        sixelplot.show()
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('dirs', type=click.Path(exists=True), nargs=-1)
+@click.option('-T', '--temp', type=float, default=None, help="Target temperature in Kelvin.")
+@click.option('-d', '--dfset', default='DFSET.dat', help='Name of the DFSET file')
+@click.option('-b', '--bands', default=None, help='Bands file to monitor (relative to the run directory)')
+@click.option('-o', '--outdir', type=click.Path(exists=True), default=None,
+              help='Write snapshots to this directory instead of the run directories.')
+@click.option('-i', '--interval', type=float, default=15, help='Time between checks (s).')
+@click.option('-j', '--json-every', type=float, default=30, help='Min. time between JSON snapshots (s).')
+@click.option('-p', '--png-every', type=float, default=300, help='Min. time between PNG snapshots (s).')
+@click.option('-1', '--once', is_flag=True, help='Write snapshots once and exit.')
+@click.option('-v', '--verbose', is_flag=True, help='Print the state of the runs.')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def hecss_monitor(dirs, temp, dfset, bands, outdir, interval, json_every, png_every, once, verbose):
+    '''
+    Monitor the HECSS runs in the DIRS directories without display.
+    Write JSON summary and PNG plot of the statistics of every run.
+    '''
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import hecss.monitor as hm
+
+    hm.monitor_daemon(dirs, T=temp, dfset=dfset, bands=bands, outdir=outdir,
+                      interval=interval, json_every=json_every, png_every=png_every,
+                      once=once, verbose=verbose)
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('ref', type=click.Path(exists=True))
+@click.argument('bands', type=click.Path(exists=True), nargs=-1)
+@click.option('-o', '--output', type=click.Path(), default=None,
+              help='Write the table to the file.')
+@click.option('-j', '--nproc', default=None, type=int, help='Number of parallel readers')
+@click.option('-s', '--summary', is_flag=True, help='Write only the total differences.')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def compare_bands(ref, bands, output, nproc, summary):
+    '''
+    Compare the phonon dispersions in the BANDS files generated by ALAMODE
+    with the reference REF. Write the table of RMS and maximum frequency
+    differences (THz) for every branch and high-symmetry point.
+    '''
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import io
+    import hecss.monitor as hm
+
+    res = hm.compare_bands(ref, bands, nproc=nproc)
+    tab = io.StringIO()
+    hm.print_bands_comparison(res, names=bands, file=tab)
+    tab = tab.getvalue()
+    if summary:
+        tab = ''.join(l for n, l in enumerate(tab.splitlines(True))
+                      if n == 0 or '\ttotal\t' in l)
+    if output:
+        with open(output, 'wt') as f:
+            f.write(tab)
+    else:
+        print(tab, end='')
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('dfset', type=click.Path(exists=True))
+@click.argument('T', type=float)
+@click.option('-s', '--scale', type=click.Path(exists=True), default=None, help='Amplitude correction history file.')
+@click.option('-S', '--supercell', type=click.Path(exists=True), default=None,
+              help='Supercell structure file for per-element report.')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def chain_stats(dfset, t, scale, supercell):
+    '''
+    Report autocorrelation times and effective sample sizes
+    of the samples in the DFSET file generated at T(K).
+    '''
+    import ase.io
+    from numpy import loadtxt
+    import hecss.monitor as hm
+
+    p = Path(dfset)
+    smpl = hm.load_dfset(p.parent, p.name)
+    nat = len(smpl[0][2])
+    xsl = None
+    if scale:
+        xsl = read_xscale_history(scale, nat)
+    sc = None
+    if supercell:
+        sc = ase.io.read(supercell)
+    print(f'Samples: {len(smpl)}')
+    hm.print_ess_report(hm.chain_ess(smpl, T=t, xsl=xsl), cryst=sc)
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('traj', type=click.Path(exists=True))
+@click.argument('supercell', type=click.Path(exists=True))
+@click.option('-d', '--dfset', default='DFSET.dat', help='Name of the output DFSET file (appended)')
+@click.option('-f', '--format', 'fmt', default=None, help='ASE format of the trajectory file')
+@click.option('-i', '--index', default=':', help='ASE index selecting frames (e.g. 1000::10)')
+@click.option('-c', '--chunk', default=1000, type=int, help='Number of frames processed at once')
+@click.option('-e', '--e0', default=None, type=float,
+              help='Energy of the base structure (eV). Default: the energy in the SUPERCELL file (or 0)')
+@click.option('-C', '--calc', default=None,
+              help='ASE calculator (e.g. emt, vasp) for the trajectories without forces')
+@click.option('-p', '--param', multiple=True, help='Parameter of the calculator (key=value, repeatable)')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def md2dfset(traj, supercell, dfset, fmt, index, chunk, e0, calc, param):
+    '''
+    Convert the MD trajectory TRAJ into displacement-force
+    set relative to the SUPERCELL structure.
+    '''
+    import ase.io
+    from ast import literal_eval
+    from ase.calculators.calculator import get_calculator_class
+    from .core import trajectory_to_dfset
+
+    base = ase.io.read(supercell)
+    if calc is not None:
+        kw = {}
+        for p in param:
+            k, _, v = p.partition('=')
+            try :
+                kw[k] = literal_eval(v)
+            except (ValueError, SyntaxError):
+                kw[k] = v
+        try :
+            calc = get_calculator_class(calc.lower())(**kw)
+        except ImportError:
+            raise click.BadParameter(f'Unknown calculator: {calc}', param_hint='--calc')
+        if base.calc is None:
+            # The energies of the frames are relative to the base calculated the same way
+            base.calc = calc
+    n = trajectory_to_dfset(traj, base, dfset, chunk=chunk, index=index,
+                            format=fmt, Ep0=e0, calc=calc)
+    print(f'Converted {n} frames.')
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('workdir', type=click.Path(exists=True))
+@click.argument('supercell', type=click.Path(exists=True))
+@click.option('-d', '--dfset', default='DFSET.dat', help='Name of the DFSET file')
+@click.option('-e', '--e0', default=None, type=float,
+              help='Energy of the base structure (eV). Read from vasprun.xml next to SUPERCELL by default.')
+@click.option('-j', '--nproc', default=None, type=int, help='Number of parallel readers')
+@click.option('-f', '--force', is_flag=True, help='Ignore the cache and parse all calculations')
+@click.option('-D', '--dedup', is_flag=True, help='Write repeated samples as multiplicities of the sets')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def hecss_rebuild(workdir, supercell, dfset, e0, nproc, force, dedup):
+    '''
+    Rebuild the DFSET file in the WORKDIR from the calculations
+    in the smpl subdirectories. SUPERCELL is the base structure.
+    '''
+    import ase.io
+    from .core import read_vasprun_ef, rebuild_dfset
+
+    base = ase.io.read(supercell)
+    vr = Path(supercell).parent.joinpath('vasprun.xml')
+    if e0 is None and base.calc is None and vr.exists():
+        ef = read_vasprun_ef(vr)
+        if ef is None:
+            raise click.ClickException(f'Incomplete reference calculation in {vr}. '
+                                       'Provide the energy of the base structure with --e0.')
+        e0 = ef[0]
+    n = rebuild_dfset(workdir, base, dfset=dfset, Ep0=e0, nproc=nproc, cache=not force, dedup=dedup)
+    print(f'Written {n} sets to {Path(workdir).joinpath(dfset)}')
+
+# Internal Cell
+# exporti
+@click.command()
+@click.argument('dfset', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.option('-D', '--dedup', is_flag=True, help='Merge repeated sets instead of expanding them')
+@click.version_option(hecss.__version__, '-V', '--version', message=_version_message)
+@click.help_option('-h', '--help')
+def dfset_export(dfset, output, dedup):
+    '''
+    Copy the DFSET file into the OUTPUT file with the sets
+    with multiplicities expanded into repeated sets.
+    '''
+    from .core import export_dfset
+
+    n = export_dfset(dfset, output, dedup=dedup)
+    print(f'Written {n} sets to {output}')
\ No newline at end of file
@@ -1,44 +1,688 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 11_core.ipynb (unless otherwise specified).
 
-__all__ = ['write_dfset', 'calc_init_xscale', 'HECSS_Sampler', 'HECSS', 'normalize_conf']
+__all__ = ['write_dfset', 'DFSETIndex', 'write_dfset_meta', 'SampleBank', 'export_dfset', 'StructureContext',
+           'structure_hash', 'get_structure_context', 'calc_init_xscale', 'History', 'AmplitudeCorrection',
+           'CalcSupervisor', 'Telemetry', 'VirialAccumulator', 'read_alamode_fc2', 'fit_force_constants',
+           'NormalModeProposal', 'HECSS_Sampler', 'model_width', 'fit_width', 'HECSS', 'HECSS_Ensemble',
+           'ASEBatchCalculator', 'HECSS_Batch_Sampler', 'JobArrayScheduler', 'LocalScheduler', 'JobArrayCalculator',
+           'autocorrelation', 'autocorr_time', 'effective_sample_size', 'ConvergenceSentinel', 'SampleBus',
+           'normalize_confs', 'normalize_conf', 'write_dfset_frames', 'iter_trajectory', 'trajectory_to_dfset',
+           'float32_errors', 'SampleStore', 'read_vasprun_ef', 'read_dfset_sequence', 'rebuild_dfset',
+           'symmetry_operations', 'augment_sample']
 
 # Cell
 import sys
+import os
+from pathlib import Path
 import ase
 import ase.units as un
-from ase.calculators import calculator
-import scipy
 import numpy as np
 from numpy import log, exp, sqrt, linspace, dot
-from scipy import stats
-from scipy.special import expit
-from tqdm.auto import tqdm
 from itertools import islice
-from spglib import find_primitive, get_symmetry_dataset
-import spglib
 from collections import Counter
 from ase.data import chemical_symbols
-from matplotlib import pyplot as plt
 
 # Cell
-def write_dfset(fn, c):
+def _dfset_header(n, i, e, w=None):
+    '''
+    Header line of the DFSET set (without the newline). The multiplicity
+    field is written only if the multiplicity `w` is given.
+    '''
+    hdr = f'# set: {n:04d} config: {i:04d}  energy: {e:8e} eV/at'
+    return hdr if w is None else hdr + f'  weight: {w:6d}'
+
+def _dfset_header_fields(l):
+    '''
+    Set number, config number, energy and multiplicity
+    from the DFSET header line `l` (str or bytes).
+    '''
+    t = l.split()
+    w = int(t[9]) if len(t) > 9 and t[8] in ('weight:', b'weight:') else 1
+    return int(t[2]), int(t[4]), float(t[6]), w
+
+def write_dfset(fn, c, dedup=False):
     '''
     Append displacement-force data from the conf to the fn file.
     The format is suitable for use as ALAMODE DFSET file.
     Optionaly you can provide configuration number in n.
     File need not exist prior to first call.
     If it does not it will be created.
+    The index of the file (see `DFSETIndex`) is updated.
+    With `dedup` the repetition of the config of the last set
+    (rejected sample) only increases the multiplicity of the set
+    (see `export_dfset`).
     '''
     n, i, x, f, e = c
+    if dedup and _bump_dfset_weight(fn, i):
+        return
     with open(fn, 'at') as dfset:
-        print(f'# set: {n:04d} config: {i:04d}  energy: {e:8e} eV/at', file=dfset)
+        start = dfset.tell()
+        print(_dfset_header(n, i, e, 1 if dedup else None), file=dfset)
         for ui, fi in zip(x,f):
             print((3*'%15.7f ' + '     ' + 3*'%15.8e ') %
                         (tuple(ui/un.Bohr) + tuple(fi*un.Bohr/un.Ry)),
                         file=dfset)
+        end = dfset.tell()
+    _append_dfset_index(fn, [(start, end, n, i, float(f'{e:8e}'), 1)])
+
+# Cell
+_DFSET_IDX_MAGIC = b'HECSSIX2'
+_dfset_idx_hdr = np.dtype([('magic', 'S8'), ('ino', '<i8')])
+_dfset_idx_dtype = np.dtype([('offset', '<i8'), ('end', '<i8'), ('set', '<i8'),
+                             ('config', '<i8'), ('energy', '<f8'), ('weight', '<i8')])
+
+def _dfset_index_path(fn):
+    fn = Path(fn)
+    return fn.with_name(f'.{fn.name}.idx')
+
+def _dfset_index_header(fn):
+    return np.array([(_DFSET_IDX_MAGIC, os.stat(fn).st_ino)], dtype=_dfset_idx_hdr).tobytes()
+
+def _append_dfset_index(fn, recs):
+    '''
+    Append the records `recs` of the sets just written to the DFSET file `fn`
+    to its index. The index is left untouched (stale) if it does not end
+    exactly where the new sets start - it will be updated on the next read.
+    '''
+    recs = np.asarray(recs, dtype=_dfset_idx_dtype)
+    if not len(recs):
+        return
+    ifn = _dfset_index_path(fn)
+    try :
+        if recs['offset'][0] == 0:
+            with open(ifn, 'wb') as idx:
+                idx.write(_dfset_index_header(fn) + recs.tobytes())
+            return
+        with open(ifn, 'r+b') as idx:
+            if idx.read(_dfset_idx_hdr.itemsize) != _dfset_index_header(fn):
+                return
+            if idx.seek(0, os.SEEK_END) < _dfset_idx_hdr.itemsize + _dfset_idx_dtype.itemsize:
+                return
+            idx.seek(-_dfset_idx_dtype.itemsize, os.SEEK_END)
+            if np.frombuffer(idx.read(), dtype=_dfset_idx_dtype)['end'][0] == recs['offset'][0]:
+                idx.write(recs.tobytes())
+    except OSError:
+        pass
+
+def _scan_dfset(fn, start=0, nlines=None):
+    '''
+    Scan the DFSET file `fn` from the byte offset `start` (beginning of a set)
+    and return the index records of the complete sets. The last set is
+    complete if it has `nlines` lines (the same as the preceding sets).
+    '''
+    recs = []
+    hdr = None
+    pos = start
+    with open(fn, 'rb') as dfset:
+        dfset.seek(start)
+        for l in dfset:
+            if l.startswith(b'# set:'):
+                if hdr is not None:
+                    recs.append((hdr[0], pos) + hdr[1:])
+                    nlines = lines
+                hdr = (pos,) + _dfset_header_fields(l)
+                lines = 0
+            lines += 1
+            pos += len(l)
+    if hdr is not None and l.endswith(b'\n') and nlines in (None, lines):
+        recs.append((hdr[0], pos) + hdr[1:])
+    return np.array(recs, dtype=_dfset_idx_dtype)
+
+def _update_dfset_index(fn):
+    '''
+    Bring the index of the DFSET file `fn` up to date.
+    Only the last record of the valid, current index is read.
+
+    Returns the number of indexed sets and the array of index records
+    if the index could not be written (None otherwise).
+    '''
+    st = os.stat(fn)
+    ifn = _dfset_index_path(fn)
+    rs = _dfset_idx_dtype.itemsize
+    hs = _dfset_idx_hdr.itemsize
+    n, last = None, None
+    try :
+        ist = os.stat(ifn)
+        with open(ifn, 'rb') as idx:
+            if idx.read(hs) == _dfset_index_header(fn) and (ist.st_size - hs) % rs == 0:
+                n = (ist.st_size - hs) // rs
+                if n:
+                    idx.seek(-rs, os.SEEK_END)
+                    last = np.frombuffer(idx.read(), dtype=_dfset_idx_dtype)[0]
+    except FileNotFoundError:
+        pass
+
+    nlines = None
+    if last is not None:
+        with open(fn, 'rb') as dfset:
+            dfset.seek(last['offset'])
+            l = dfset.readline()
+            if last['end'] <= st.st_size and l.startswith(b'# set:'):
+                s, _, c = l.split()[2:5]
+                nlines = dfset.read(last['end'] - dfset.tell()).count(b'\n') + 1
+            if nlines is None or (int(s), int(c)) != (last['set'], last['config']):
+                # The file was rewritten
+                n, last = None, None
+            elif last['end'] == st.st_size:
+                if st.st_mtime_ns <= ist.st_mtime_ns:
+                    return n, None
+                # Rewritten in place with the same size
+                n, last = None, None
+    elif n == 0 and st.st_size == 0:
+        return 0, None
+
+    start = 0 if last is None else int(last['end'])
+    recs = _scan_dfset(fn, start, nlines)
+    try :
+        if last is None:
+            tmp = ifn.with_name(ifn.name + f'.{os.getpid()}')
+            with open(tmp, 'wb') as idx:
+                idx.write(_dfset_index_header(fn) + recs.tobytes())
+            os.replace(tmp, ifn)
+        elif len(recs):
+            with open(ifn, 'ab') as idx:
+                idx.write(recs.tobytes())
+        else :
+            # Incomplete set at the end - nothing to index yet
+            os.utime(ifn)
+        return (0 if last is None else n) + len(recs), None
+    except OSError:
+        if last is not None:
+            recs = np.concatenate((np.fromfile(ifn, dtype=_dfset_idx_dtype, offset=hs), recs))
+        return len(recs), recs
+
+# Cell
+class DFSETIndex:
+    '''
+    Random access to the sets of the DFSET file `fn` through its sidecar index.
+    The index behaves as a read-only sequence of samples `(n, i, x, f, e)`
+    (in ASE units, as returned by the sampler) read from the file on demand.
+    The index is checked against the DFSET file on every access, thus the
+    object may be kept while the file grows.
+
+    Attributes
+    ----------
+    records  : Structured array of the index records
+               (offset, end, set, config, energy, weight)
+    sets     : Set numbers
+    configs  : Config numbers
+    energies : Energies of the sets (eV/at)
+    weights  : Multiplicities of the sets (see `export_dfset`)
+    '''
+    def __init__(self, fn):
+        self.fn = Path(fn)
+        self._recs = np.zeros(0, dtype=_dfset_idx_dtype)
+        self._stamp = None
+
+    def __len__(self):
+        return _update_dfset_index(self.fn)[0]
+
+    @property
+    def records(self):
+        n, recs = _update_dfset_index(self.fn)
+        if recs is not None:
+            self._recs = recs
+            self._stamp = None
+            return recs
+        ifn = _dfset_index_path(self.fn)
+        ist = os.stat(ifn)
+        stamp = (ist.st_ino, ist.st_size, ist.st_mtime_ns)
+        if stamp != self._stamp:
+            recs = np.fromfile(ifn, dtype=_dfset_idx_dtype, offset=_dfset_idx_hdr.itemsize)
+            if len(recs) > 1 and (np.diff(recs['offset']) <= 0).any():
+                # Concurrent updates corrupted the index - rebuild it
+                ifn.unlink()
+                return self.records
+            self._recs, self._stamp = recs, stamp
+        return self._recs
+
+    @property
+    def sets(self):
+        return self.records['set']
+
+    @property
+    def configs(self):
+        return self.records['config']
+
+    @property
+    def energies(self):
+        return self.records['energy']
+
+    @property
+    def weights(self):
+        return self.records['weight']
+
+    def select(self, emin=None, emax=None):
+        '''
+        Indices of the sets with energies (eV/at) in the [emin, emax] window.
+        '''
+        e = self.energies
+        sel = np.ones(len(e), dtype=bool)
+        if emin is not None:
+            sel &= e >= emin
+        if emax is not None:
+            sel &= e <= emax
+        return np.flatnonzero(sel)
+
+    def read(self, idx=None, expand=False):
+        '''
+        Read the sets with indices `idx` (all by default).
+        Returns the list of samples `(n, i, x, f, e)`.
+        With `expand` every set is repeated according to its multiplicity
+        (with consecutive set numbers), as in the plain DFSET file.
+        The repeated samples share the arrays.
+        '''
+        recs = self.records
+        if idx is not None:
+            recs = recs[idx]
+        smpl = []
+        with open(self.fn, 'rb') as dfset:
+            for r in recs:
+                dfset.seek(r['offset'])
+                d = dfset.read(r['end'] - r['offset']).split(b'\n', 1)[1]
+                d = np.array(d.split(), dtype=float).reshape(-1, 6)
+                smpl.append((int(r['set']), int(r['config']),
+                             d[:, :3]*un.Bohr, d[:, 3:]*un.Ry/un.Bohr, float(r['energy'])))
+        if expand:
+            smpl = [(s[0] + k,) + s[1:] for s, w in zip(smpl, recs['weight']) for k in range(w)]
+        return smpl
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self.read(k)
+        return self.read([k])[0]
+
+# Cell
+def _energy_dist(T_goal, nat):
+    '''Mean and width of the target energy distribution (eV/at)'''
+    return 3*T_goal*un.kB/2, np.sqrt(3/2)*un.kB*T_goal/np.sqrt(nat)
+
+def _dfset_meta_path(fn):
+    fn = Path(fn)
+    return fn.with_name(f'.{fn.name}.meta')
+
+def write_dfset_meta(fn, c, T_goal):
+    '''
+    Append the sampling metadata of the sample `c` = (n, i, x, f, e)
+    written to the DFSET file `fn`: the target temperature and the
+    mean (`mu`) and width (`sigma`) of the normal energy distribution
+    the sample was drawn from. The metadata go to the `.{name}.meta`
+    file next to the DFSET file.
+    '''
+    import json
+    n, i, x, f, e = c
+    mu, sigma = _energy_dist(T_goal, len(x))
+    with open(_dfset_meta_path(fn), 'at') as mf:
+        print(json.dumps({'set': int(n), 'config': int(i), 'T': T_goal,
+                          'mu': mu, 'sigma': sigma}), file=mf)
+
+# Cell
+class SampleBank:
+    '''
+    Bank of the samples of past runs for reuse at other temperatures.
+
+    INPUT
+    -----
+    dfsets : DFSET files of the runs
+    T      : Target temperature of the runs without the metadata file
+             (see `write_dfset_meta`). None - the metadata are required.
+
+    The bank holds the energies and the parameters of the energy distributions
+    of all configurations. The sets of the same config (repeated on rejection)
+    are one draw with the multiplicity (`mult`) - they are not independent.
+    The configurations are read from the files (see `DFSETIndex`) only when drawn.
+    '''
+    def __init__(self, dfsets=(), T=None):
+        self.sources = []
+        self.nat = None
+        self.e = np.zeros(0)
+        self.mu = np.zeros(0)
+        self.sigma = np.zeros(0)
+        self.mult = np.zeros(0, dtype=int)
+        self.src = np.zeros(0, dtype=int)
+        self.pos = np.zeros(0, dtype=int)
+        for fn in dfsets:
+            self.add(fn, T)
+
+    def __len__(self):
+        return len(self.e)
+
+    def add(self, fn, T=None):
+        '''
+        Add the sets from the DFSET file `fn` to the bank. The temperature `T`
+        is used for the sets without metadata. Returns the number of added
+        samples (the repeated configs are counted with their multiplicity).
+        '''
+        import json
+        dfi = DFSETIndex(fn)
+        if not len(dfi):
+            return 0
+        nat = len(dfi[0][2])
+        if self.nat is None:
+            self.nat = nat
+        if nat != self.nat:
+            raise ValueError(f'Different supercell in {fn}: {nat} atoms instead of {self.nat}')
+        meta = {}
+        try :
+            with open(_dfset_meta_path(fn)) as mf:
+                for l in mf:
+                    m = json.loads(l)
+                    meta[m['set']] = (m['mu'], m['sigma'])
+        except FileNotFoundError:
+            pass
+        if T is not None:
+            dflt = _energy_dist(T, nat)
+            dist = np.array([meta.get(s, dflt) for s in dfi.sets])
+        elif all(s in meta for s in dfi.sets):
+            dist = np.array([meta[s] for s in dfi.sets])
+        else :
+            raise ValueError(f'No sampling metadata for {fn}. Provide the temperature of the run.')
+        # Repetitions of the config (and sets with multiplicities) are one draw
+        _, first, inv = np.unique(dfi.configs, return_index=True, return_inverse=True)
+        mult = np.bincount(inv.ravel(), weights=dfi.weights).astype(int)
+        self.sources.append(dfi)
+        self.e = np.concatenate((self.e, dfi.energies[first]))
+        self.mu = np.concatenate((self.mu, dist[first, 0]))
+        self.sigma = np.concatenate((self.sigma, dist[first, 1]))
+        self.mult = np.concatenate((self.mult, mult))
+        self.src = np.concatenate((self.src, np.full(len(first), len(self.sources)-1)))
+        self.pos = np.concatenate((self.pos, first))
+        return int(mult.sum())
+
+    def weights(self, T):
+        '''
+        Normalized importance weights of the configurations for the target
+        temperature `T`. The samples of all runs are treated as drawn from
+        the mixture of the energy distributions of the runs. The weight of
+        the config includes its multiplicity.
+        '''
+        from scipy import stats
+        if not len(self):
+            return np.zeros(0)
+        dist, inv = np.unique(np.stack((self.mu, self.sigma)), axis=1, return_inverse=True)
+        cnt = np.bincount(inv.ravel(), weights=self.mult)
+        q = (cnt * stats.norm.pdf(self.e[:, None], dist[0], dist[1])).sum(axis=1) / self.mult.sum()
+        w = self.mult * stats.norm.pdf(self.e, *_energy_dist(T, self.nat)) / q
+        return w / w.sum() if w.sum() > 0 else w
+
+    def ess(self, T):
+        '''
+        Effective sample size of the bank at the temperature `T`.
+        The repeated configs are counted once, thus the ESS does not
+        exceed the number of distinct configs.
+        '''
+        w = self.weights(T)
+        return 1/(w**2).sum() if w.sum() > 0 else 0
+
+    def needed(self, T, N):
+        '''
+        Number of fresh samples needed to get `N` samples at the temperature `T`.
+        '''
+        return max(0, N - int(self.ess(T)))
+
+    def draw(self, T, N=None, seed=None, start=None):
+        '''
+        Draw the sample of the distribution at the temperature `T` from the bank
+        by the systematic resampling with the importance weights. The size of
+        the sample is limited to the effective sample size (and to `N`).
+        Returns the list of samples `(n, i, x, f, e)` as stored in the DFSET files.
+        If `start=(n, i)` is given, the samples are renumbered as the continuation
+        of the sequence: numbers from `n+1` and configs from `i` (the same config
+        drawn repeatedly keeps its number).
+        '''
+        w = self.weights(T)
+        n = int(self.ess(T))
+        if N is not None:
+            n = min(n, N)
+        if n < 1:
+            return []
+        rng = np.random.default_rng(seed)
+        idx = np.searchsorted(np.cumsum(w), (rng.random() + np.arange(n))/n)
+        idx = np.minimum(idx, len(w)-1)
+        smpl = {}
+        for s in np.unique(self.src[idx]):
+            sel = np.unique(idx[self.src[idx] == s])
+            smpl.update(zip(sel, self.sources[s].read(self.pos[sel])))
+        if start is None:
+            return [smpl[k] for k in idx]
+        cfg = start[1] + np.cumsum(np.diff(idx, prepend=idx[0]) != 0)
+        return [(start[0] + j + 1, int(c)) + tuple(smpl[k][2:])
+                for j, (k, c) in enumerate(zip(idx, cfg))]
+
+# Cell
+def _bump_dfset_weight(fn, i):
+    '''
+    Increase the multiplicity of the last set of the DFSET file `fn`
+    if it holds the config `i` and has the multiplicity field.
+    The header and the index record are updated in place.
+    Returns True if the set was updated.
+    '''
+    if not os.path.exists(fn):
+        return False
+    n, recs = _update_dfset_index(fn)
+    if not n:
+        return False
+    ifn = _dfset_index_path(fn)
+    rs = _dfset_idx_dtype.itemsize
+    if recs is None:
+        with open(ifn, 'rb') as idx:
+            idx.seek(-rs, os.SEEK_END)
+            recs = np.frombuffer(idx.read(), dtype=_dfset_idx_dtype)
+    r = recs[-1].copy()
+    if r['config'] != i:
+        return False
+    with open(fn, 'r+b') as dfset:
+        dfset.seek(r['offset'])
+        l = dfset.readline().rstrip(b'\n')
+        k = l.find(b'weight:')
+        fld = b'weight: %6d' % (r['weight'] + 1)
+        if k < 0 or len(fld) != len(l) - k:
+            # Plain set or no room for the larger number
+            return False
+        dfset.seek(r['offset'] + k)
+        dfset.write(fld)
+    r['weight'] += 1
+    try :
+        # Written after the DFSET file - the index stays current
+        with open(ifn, 'r+b') as idx:
+            idx.seek(-rs, os.SEEK_END)
+            idx.write(r.tobytes())
+    except OSError:
+        pass
+    return True
+
+# Cell
+def export_dfset(fn, out, dedup=False):
+    '''
+    Copy the DFSET file `fn` into the `out` file (overwritten).
+    The data lines are copied verbatim, only the headers are rewritten.
+
+    INPUT
+    -----
+    fn    : Source DFSET file
+    out   : Output DFSET file
+    dedup : False - expand the sets with multiplicities into the plain
+            repeated sets (with consecutive set numbers) as expected by
+            ALAMODE and other tools.
+            True - merge the consecutive repetitions of the configuration
+            into a single set with the multiplicity.
+
+    OUTPUT
+    ------
+    Number of sets written to the `out` file.
+    '''
+    if Path(fn).resolve() == Path(out).resolve():
+        raise ValueError('The output must be a different file.')
+    recs = DFSETIndex(fn).records
+    if os.path.exists(out):
+        os.remove(out)
+    orecs = []
+    pos = 0
+    prev = None
+
+    def emit(dst, n, i, e, w, d):
+        nonlocal pos
+        for k in range(1 if dedup else w):
+            blk = (_dfset_header(n + k, i, e, w if dedup else None) + '\n').encode() + d
+            dst.write(blk)
+            orecs.append((pos, pos + len(blk), n + k, i, e, w if dedup else 1))
+            pos += len(blk)
+
+    with open(fn, 'rb') as src, open(out, 'wb') as dst:
+        for r in recs:
+            src.seek(r['offset'])
+            d = src.read(r['end'] - r['offset']).split(b'\n', 1)[1]
+            cur = [int(r['set']), int(r['config']), float(r['energy']), int(r['weight']), d]
+            # The same config with the same data (the symmetry images share the config)
+            if dedup and prev is not None and prev[1] == cur[1] and prev[4] == d:
+                prev[3] += cur[3]
+                continue
+            if prev is not None:
+                emit(dst, *prev)
+            prev = cur
+        if prev is not None:
+            emit(dst, *prev)
+    _append_dfset_index(out, orecs)
+    return len(orecs)
 
 # Cell
-def calc_init_xscale(cryst, xsl, skip=None):
+class StructureContext:
+    '''
+    Symmetry, DOF and element data of the structure `cryst`.
+    The symmetry dataset is calculated with spglib (with `symprec`
+    treshold) unless it is passed in the `symm` dictionary
+    (with `mapping_to_primitive`, `rotations` and `translations` items).
+
+    Attributes
+    ----------
+    nat      : Number of atoms
+    numbers  : Atomic numbers of the atoms
+    elements : Sorted array of distinct atomic numbers
+    elidx    : Dictionary of index arrays of atoms of each element
+    elmask   : Dictionary of boolean masks of atoms of each element
+    dofmap   : Mapping of atoms onto DOF (primitive cell atoms)
+    dof      : Sorted array of DOF
+    dofidx   : Position of the DOF of every atom in the `dof` array
+    dofmul   : Multiplicities (number of images) of the DOF
+    dofel    : Atomic numbers of the DOF
+    '''
+    def __init__(self, cryst, symprec=1e-5, symm=None):
+        if symm is None:
+            from spglib import get_symmetry_dataset
+            symm = get_symmetry_dataset(cryst, symprec=symprec)
+        self.symprec = symprec
+        self.rotations = np.asarray(symm['rotations'])
+        self.translations = np.asarray(symm['translations'])
+        self.lattice = np.asarray(cryst.get_cell())
+        self.spos = cryst.get_scaled_positions()
+        self.nat = len(cryst)
+        self.numbers = cryst.get_atomic_numbers()
+        self.elements = np.unique(self.numbers)
+        self.elidx = {el: np.flatnonzero(self.numbers == el) for el in self.elements}
+        self.elmask = {el: self.numbers == el for el in self.elements}
+        self.dofmap = np.asarray(symm['mapping_to_primitive'])
+        self.dof, first, self.dofidx, self.dofmul = np.unique(self.dofmap, return_index=True,
+                                                              return_inverse=True, return_counts=True)
+        self.dofel = self.numbers[first]
+        self._ops = {}
+
+    def dof_mean(self, a):
+        '''
+        Average the `(..., nat, 3)` array over the images of every DOF.
+        Returns `(..., ndof, 3)` array.
+        '''
+        a = np.asarray(a)
+        nd = len(self.dof)
+        # Stack all (..., 3) components in separate bins of one bincount
+        b = np.moveaxis(a.reshape((-1,) + a.shape[-2:]), -1, -2).reshape(-1, a.shape[-2])
+        idx = self.dofidx + nd*np.arange(len(b))[:,None]
+        s = np.bincount(idx.ravel(), b.ravel(), minlength=nd*len(b)).reshape(-1, a.shape[-1], nd)
+        return (np.moveaxis(s, -1, -2) / self.dofmul[:,None]).reshape(a.shape[:-2] + (nd, a.shape[-1]))
+
+    def el_mean(self, a):
+        '''
+        Average the `(..., nat, 3)` array over the atoms of every element
+        and over directions. Returns `(..., nelem)` array.
+        '''
+        a = np.asarray(a)
+        return np.stack([a[..., idx, :].mean(axis=(-2,-1)) for idx in self.elidx.values()], axis=-1)
+
+    def operations(self, unique_rotations=True):
+        '''
+        Carthesian rotations and atom permutations of the symmetry operations.
+        See `symmetry_operations` for details. The result is cached.
+        '''
+        if unique_rotations not in self._ops:
+            rots, trans = self.rotations, self.translations
+            if unique_rotations:
+                _, idx = np.unique(rots.reshape(len(rots), -1), axis=0, return_index=True)
+                idx = np.sort(idx)
+                rots, trans = rots[idx], trans[idx]
+            lat = self.lattice
+            # Rotations acting on carthesian column vectors
+            crot = np.einsum('ji,kjl,ml->kim', lat, rots, np.linalg.inv(lat))
+            # Periodic nearest-neighbour search in fractional coordinates
+            from scipy.spatial import cKDTree
+            spos = self.spos - np.floor(self.spos)
+            spos[spos >= 1] = 0
+            tree = cKDTree(spos, boxsize=1)
+            perm = np.empty((len(rots), self.nat), dtype=int)
+            for k, (r, t) in enumerate(zip(rots, trans)):
+                p = self.spos @ r.T + t
+                p -= np.floor(p)
+                p[p >= 1] = 0
+                perm[k] = tree.query(p)[1]
+            # Every operation must be a permutation of the atoms
+            assert all(len(set(p)) == self.nat for p in perm)
+            self._ops[unique_rotations] = (crot, perm)
+        return self._ops[unique_rotations]
+
+# Cell
+_structure_contexts = {}
+
+def structure_hash(cryst, symprec=1e-5):
+    '''
+    Hash of the structure (atomic numbers, cell, positions) and `symprec`.
+    '''
+    from hashlib import sha1
+    h = sha1()
+    for a in (cryst.get_atomic_numbers(), cryst.get_cell(), cryst.get_scaled_positions()):
+        h.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    h.update(repr(float(symprec)).encode())
+    return h.hexdigest()
+
+
+def get_structure_context(cryst, symprec=1e-5, cache_dir=None):
+    '''
+    Return the `StructureContext` of the structure `cryst`.
+    The contexts are cached in memory and, if the `cache_dir`
+    is given or the `HECSS_CACHE_DIR` environment variable is set,
+    the symmetry data are stored in the `{hash}.npz` files
+    in the cache directory.
+    '''
+    key = structure_hash(cryst, symprec)
+    if key in _structure_contexts:
+        return _structure_contexts[key]
+    if cache_dir is None:
+        cache_dir = os.environ.get('HECSS_CACHE_DIR')
+    symm = None
+    if cache_dir:
+        fn = Path(cache_dir) / f'{key}.npz'
+        if fn.exists():
+            with np.load(fn) as cd:
+                symm = {k: cd[k] for k in ('mapping_to_primitive', 'rotations', 'translations')}
+    ctx = StructureContext(cryst, symprec, symm)
+    if cache_dir and symm is None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp = Path(cache_dir) / f'.{key}.{os.getpid()}.npz'
+        np.savez(tmp, mapping_to_primitive=ctx.dofmap,
+                 rotations=ctx.rotations, translations=ctx.translations)
+        os.replace(tmp, fn)
+    _structure_contexts[key] = ctx
+    return ctx
+
+# Cell
+def calc_init_xscale(cryst, xsl, skip=None, ctx=None):
     '''
     Calculate initial xscale amplitude correction coefficients
     from the history exported from the previous calculation
@@ -48,8 +692,10 @@ def calc_init_xscale(cryst, xsl, skip=None):
     -----
     cryst : ASE structure
     xsl   : List of amplitude correction coefficients. The shape of
-            each element of the list must be `cryst.get_positions().shape`
+            each element of the list must be `cryst.get_positions().shape`.
+            May be also the `History` of the coefficients.
     skip  : Number of samples to skip at the start of the xsl list
+    ctx   : `StructureContext` of the structure (created if None)
 
     OUTPUT
     ------
@@ -57,16 +703,723 @@ def calc_init_xscale(cryst, xsl, skip=None):
     `cryst.get_positions().shape`. May be directly plugged into
     `xscale_init` argument of `HECSS_Sampler` or `HECSS`.
     '''
-    from numpy import array, ones
-    elmap = cryst.get_atomic_numbers()
-    if skip is not None:
-        skip = min(skip, len(xsl)//2)
-    xs = array(xsl)[skip:]
-    xscale = ones(xs[0].shape)
-    for i, el in enumerate(set(elmap)):
-        xscale[elmap==el] = xs[skip:,elmap==el,:].mean()
+    from numpy import array, ones, arange
+    if ctx is None:
+        ctx = get_structure_context(cryst)
+    if isinstance(xsl, History):
+        t, xel = xsl.steps, xsl.el_mean()
+    else :
+        xel = ctx.el_mean(array(xsl))
+        t = arange(1, len(xel)+1)
+    if skip is None:
+        skip = 0
+    skip = min(skip, t[-1]//2)
+    xscale = ones((ctx.nat, 3))
+    for k, idx in enumerate(ctx.elidx.values()):
+        xscale[idx] = xel[t > skip, k].mean()
     return xscale
 
+# Cell
+class History:
+    '''
+    Decimated history of the `(rows, 3)` arrays recorded by the sampler.
+    May be used in place of the list in the `xscale_list` and `dofmu_list`
+    parameters and in the analysis functions (`calc_init_xscale`,
+    `plot_xs_stat`, `plot_dofmu_stat`, `chain_ess`).
+
+    INPUT
+    -----
+    ctx      : `StructureContext` of the structure
+    mode     : Recorded aggregate of the array: 'element' - mean over
+               the rows of every element and directions, 'dof' - mean over
+               the images of every DOF, 'full' - the complete array
+    every    : Record every `every`-th step
+    snapshot : Keep the complete array every `snapshot` steps (None - never)
+    dtype    : Type of the recorded data (e.g. `np.float32` to halve the memory)
+
+    The rows of the arrays are the atoms (`xscale`) or the DOF (`dofmu`).
+    The items of the history are the recorded steps expanded to the full
+    `(rows, 3)` shape (the rows of the element or the images of the DOF
+    get the same value), thus `array(history)` has the same shape as the
+    array of the full list. The `el_mean` method returns the per-element
+    means without the expansion. The history may be stored in the (small)
+    `.npz` file with `save` and read back with `History.load`.
+
+    Attributes
+    ----------
+    n         : Number of appended steps
+    steps     : Array of the (1-based) numbers of the recorded steps
+    records   : `(recorded, stored rows, 1 or 3)` array of the aggregates
+    snapshots : List of the (step, array) complete snapshots
+    '''
+    def __init__(self, ctx, mode='element', every=1, snapshot=None, dtype=float):
+        if mode not in ('element', 'dof', 'full'):
+            raise ValueError(f'Unknown history mode: {mode}')
+        self.ctx = ctx
+        self.mode, self.every, self.snapshot = mode, every, snapshot
+        self.dtype = np.dtype(dtype)
+        self.elements = ctx.elements
+        self.n = 0
+        self._steps, self._rec = [], []
+        self.snapshots = []
+        self.rowmap = None
+
+    def _setup(self, rows):
+        ctx = self.ctx
+        if rows == ctx.nat:
+            rowel = ctx.numbers
+        elif rows == len(ctx.dof):
+            rowel = ctx.dofel
+        else :
+            raise ValueError(f'Wrong number of rows: {rows} (atoms: {ctx.nat}, DOF: {len(ctx.dof)})')
+        # Stored row of every row, its element and number of rows it represents
+        if self.mode == 'element':
+            self.rowmap = np.searchsorted(self.elements, rowel)
+            self.recel = self.elements
+        elif self.mode == 'dof' and rows == ctx.nat:
+            self.rowmap, self.recel = ctx.dofidx, ctx.dofel
+        else :
+            self.rowmap, self.recel = np.arange(rows), rowel
+        self.recw = np.bincount(self.rowmap, minlength=len(self.recel))
+
+    def append(self, a):
+        '''Add the `(rows, 3)` array of the next step'''
+        a = np.asarray(a)
+        if self.rowmap is None:
+            self._setup(len(a))
+        self.n += 1
+        if (self.n - 1) % self.every == 0:
+            if self.mode == 'full':
+                rec = np.array(a, dtype=self.dtype)
+            else :
+                v = a.mean(axis=1, keepdims=True) if self.mode == 'element' else a
+                rec = np.stack([np.bincount(self.rowmap, v[:, k], minlength=len(self.recw))
+                                for k in range(v.shape[1])], axis=-1) / self.recw[:, None]
+            self._steps.append(self.n)
+            self._rec.append(rec.astype(self.dtype, copy=False))
+        if self.snapshot and self.n % self.snapshot == 0:
+            self.snapshots.append((self.n, np.array(a, dtype=self.dtype)))
+
+    @property
+    def steps(self):
+        return np.array(self._steps, dtype=int)
+
+    @property
+    def records(self):
+        return np.array(self._rec)
+
+    def __len__(self):
+        return len(self._rec)
+
+    def _expand(self, r):
+        return np.array(np.broadcast_to(r[..., self.rowmap, :], r.shape[:-2] + (len(self.rowmap), 3)))
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self._expand(r) for r in self._rec[k]]
+        return self._expand(self._rec[k])
+
+    def __iter__(self):
+        for r in self._rec:
+            yield self._expand(r)
+
+    def __array__(self, dtype=None, copy=None):
+        if not self._rec:
+            return np.zeros((0, 0, 3), dtype=dtype)
+        return self._expand(self.records).astype(dtype, copy=False)
+
+    def el_mean(self):
+        '''Per-element means of the recorded steps (`(recorded, nelem)` array)'''
+        r = self.records
+        s = r.sum(axis=-1) * self.recw
+        return np.stack([s[:, self.recel == el].sum(axis=-1) / (self.recw[self.recel == el].sum() * r.shape[-1])
+                         for el in self.elements], axis=-1)
+
+    def save(self, fn, compress=False):
+        '''
+        Write the history to the `fn` file (replaced atomically).
+        With `compress` the data are compressed (losslessly) with zlib.
+        '''
+        fn = Path(fn)
+        tmp = fn.parent / f'.{fn.name}.tmp'
+        # The sampler may append in the meantime (e.g. on the SampleBus)
+        nr, snaps = len(self._rec), list(self.snapshots)
+        save = np.savez_compressed if compress else np.savez
+        with open(tmp, 'wb') as f:
+            save(f, mode=self.mode, every=self.every, snapshot=self.snapshot or 0, n=self.n,
+                 steps=np.array(self._steps[:nr], dtype=int), records=np.array(self._rec[:nr]),
+                 elements=self.elements, rowmap=self.rowmap, recel=self.recel, recw=self.recw,
+                 snap_steps=np.array([s for s, a in snaps], dtype=int),
+                 snaps=np.array([a for s, a in snaps]))
+        os.replace(tmp, fn)
+
+    @classmethod
+    def load(cls, fn):
+        '''Read the history written by `save`'''
+        h = cls.__new__(cls)
+        with np.load(fn) as d:
+            h.ctx = None
+            h.mode, h.every, h.n = str(d['mode']), int(d['every']), int(d['n'])
+            h.snapshot = int(d['snapshot']) or None
+            h._steps, h._rec = list(d['steps']), list(d['records'])
+            h.dtype = d['records'].dtype
+            h.elements, h.rowmap, h.recel, h.recw = d['elements'], d['rowmap'], d['recel'], d['recw']
+            h.snapshots = list(zip(d['snap_steps'], d['snaps']))
+        return h
+
+# Cell
+class AmplitudeCorrection:
+    '''
+    State of the amplitude correction (equilibration of the DOF virials)
+    used by `HECSS_Sampler`. The single object may be shared by several
+    walkers sampling the same structure (see `HECSS_Ensemble`). The virial
+    estimates from `pool` calculations are then pooled into one update,
+    which is equivalent to applying all of them in sequence.
+
+    INPUT
+    -----
+    ctx          : `StructureContext` of the structure
+    xscale_init  : Initial values of the amplitude correction coefficients
+    eqdelta      : Max. speed of amplitude correction from step to step (0.05=5%)
+    eqsigma      : Half width of linear part of amplitude correction function.
+    xi           : strength of the amplitude correction term [0-1]
+    chi          : strength of the amplitude correction term mixing [0-1]
+    pool         : Number of virial estimates pooled in one update
+    inplace      : Update the `xscale` array in place (low-overhead mode).
+                   Not suitable for the object shared by threads.
+    '''
+    def __init__(self, ctx, xscale_init=None, eqdelta=0.05, eqsigma=0.2,
+                 xi=1, chi=1, pool=1, inplace=False):
+        from threading import Lock
+        dim = (ctx.nat, 3)
+        if xscale_init is None:
+            xscale = np.ones(dim)
+        else :
+            xscale = np.array(xscale_init)
+            assert xscale.shape == dim
+        self.ctx = ctx
+        self.xscale = xscale
+        # Initialise dofxs from data passed in xscale_init
+        self.dofxs = ctx.dof_mean(xscale)
+        self.eqdelta = eqdelta
+        self.eqsigma = eqsigma
+        self.xi = min(1, max(0, xi))
+        self.chi = min(1, max(0, chi))
+        self.pool = pool
+        self.inplace = inplace
+        self._buf = np.empty(dim) if inplace else None
+        self.updates = 0
+        self._factor = np.ones(self.dofxs.shape)
+        self._pooled = 0
+        self._lock = Lock()
+
+    def update(self, mu):
+        '''
+        Add the virial estimate `mu` (`(nat, 3)` array, relative to kT)
+        from one calculation or the `(M, nat, 3)` array of M estimates.
+        The amplitude correction coefficients are updated after `pool`
+        estimates. Returns the DOF virials.
+        '''
+        from scipy.special import expit
+        # Avarage mu over images of the atom in the P.U.C.
+        dofmu = self.ctx.dof_mean(mu)
+        # We use sqrt(mu) since the energy is quadratic in position
+        # eqdelta = 0.05 => 5% maximum change in xscale from step to step
+        # eqsigma = 0.2 => half width/sharpness of the sigmoid,
+        #                  roughly linear part of the curve
+        fct = (1-2*self.eqdelta*(expit((np.sqrt(dofmu)-1)/self.eqsigma)-0.5))
+        fct = fct.reshape((-1,) + self.dofxs.shape)
+        with self._lock:
+            self._factor *= fct.prod(axis=0)
+            self._pooled += len(fct)
+            if self._pooled >= self.pool:
+                dofxs = self.dofxs * self._factor
+                # We need to normalize to unchanged energy ~ xs**2
+                # The scale must be back linear in xs, thus sqrt(<xs>)
+                dofxs /= np.sqrt((dofxs**2).mean())
+                if self.inplace:
+                    # The same operations as below without temporary arrays
+                    xscale = self.xscale
+                    np.take(dofxs, self.ctx.dofidx, axis=0, out=self._buf)
+                    self._buf *= self.chi
+                    xscale *= (1 - self.chi)
+                    xscale += self._buf
+                    xscale *= self.xi
+                    xscale += 1
+                    xscale -= self.xi
+                else :
+                    xscale = (self.chi * dofxs[self.ctx.dofidx] + self.xscale * (1 - self.chi))
+                    # mix with unity: (xi*xs + (1-xi)*1), 0 < xi < 1
+                    # New arrays are assigned, the walkers may hold the old ones
+                    self.xscale = (self.xi*xscale + 1 - self.xi)
+                self.dofxs = dofxs
+                self._factor = np.ones(dofxs.shape)
+                self._pooled = 0
+                self.updates += 1
+        return dofmu
+
+# Cell
+class CalcSupervisor:
+    '''
+    Supervise the calculator calls of the sampler.
+
+    INPUT
+    -----
+    timeout      : Wall-clock limit (s) of one calculation. Works with the
+                   calculators running external `command` (e.g. Vasp), which
+                   is killed with the `timeout` utility. None - no limit.
+    grace        : Time (s) between TERM and KILL signals on timeout
+    retries      : Number of retries of the failed calculation
+    backoff      : Delay (s) before the first retry, doubled on every next one
+    quarantine   : Move the directory of the failed calculation to the
+                   `failed/{name}.{k}` subdirectory of its parent directory
+    max_abandoned: Stop the sampler after that number of configurations
+                   abandoned after all retries. None - never stop.
+
+    The `stats` dictionary counts: `calls`, `failures`, `timeouts`,
+    `retries`, `quarantined` and `abandoned` calculations.
+    '''
+    def __init__(self, timeout=None, grace=10, retries=0, backoff=1,
+                 quarantine=False, max_abandoned=None):
+        from threading import Lock
+        self.timeout = timeout
+        self.grace = grace
+        self.retries = retries
+        self.backoff = backoff
+        self.quarantine = quarantine
+        self.max_abandoned = max_abandoned
+        self.stats = dict(calls=0, failures=0, timeouts=0, retries=0, quarantined=0, abandoned=0)
+        self._lock = Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    @property
+    def exhausted(self):
+        '''
+        True if the limit of abandoned configurations is reached.
+        '''
+        return self.max_abandoned is not None and self.stats['abandoned'] >= self.max_abandoned
+
+    def _limit(self, calc):
+        '''
+        Wrap the command of the calculator with the timeout utility.
+        Returns the original command or False if the calculator has none.
+        '''
+        import shlex
+        if self.timeout is None or not hasattr(calc, 'command'):
+            return False
+        orig = calc.command
+        cmd = calc.make_command(orig) if hasattr(calc, 'make_command') else orig
+        if not cmd:
+            return False
+        calc.command = f'timeout -k {self.grace} {self.timeout} sh -c {shlex.quote(cmd)}'
+        return orig
+
+    def _move(self, directory):
+        if not self.quarantine or directory is None:
+            return
+        d = Path(directory)
+        if not d.is_dir() or d.resolve() == Path.cwd():
+            return
+        qd = d.parent / 'failed'
+        qd.mkdir(exist_ok=True)
+        k = 1
+        while (qd / f'{d.name}.{k}').exists():
+            k += 1
+        d.rename(qd / f'{d.name}.{k}')
+        self._count('quarantined')
+
+    def __call__(self, calc, compute, directory=None):
+        '''
+        Run `compute()` supervising the `calc` calculator working in the
+        `directory`. Returns the result of `compute` or raises the
+        `CalculatorError` if all attempts failed.
+        '''
+        from time import sleep, monotonic
+        from ase.calculators import calculator
+        for attempt in range(self.retries + 1):
+            self._count('calls')
+            orig = self._limit(calc)
+            t = monotonic()
+            try :
+                return compute()
+            except calculator.CalculatorError as err:
+                if orig is not False and monotonic() - t >= self.timeout:
+                    self._count('timeouts')
+                    print(f'Calculation in {directory} timed out.', file=sys.stderr)
+                else :
+                    self._count('failures')
+                    print(f'Calculation in {directory} failed: {err}', file=sys.stderr)
+                self._move(directory)
+                if attempt < self.retries:
+                    self._count('retries')
+                    sleep(self.backoff * 2**attempt)
+            finally :
+                if orig is not False:
+                    calc.command = orig
+        self._count('abandoned')
+        raise calculator.CalculatorError(f'Calculation in {directory} failed {self.retries + 1} times.')
+
+# Cell
+class Telemetry:
+    '''
+    Progress telemetry of the sampler with O(1) per-step cost.
+
+    INPUT
+    -----
+    pbar     : tqdm progress bar - the state is shown in its postfix
+    log      : File-like object (e.g. `sys.stdout`) for the plain log lines
+    jsonl    : File-like object or file name for the JSON lines records
+    interval : Min. time (s) between the outputs. The changes of the phase
+               (burn-in/sampling) are always reported.
+
+    The state of the sampler is held in the attributes: `n` (sample number),
+    `i` (accepted configurations), `k` (burn-in step), `w` (width), `alpha`
+    (acceptance probability), `r` (rejections in a row) and `e_star`
+    (energy of the last proposal). The `state` method returns the dictionary
+    of the current state and aggregates.
+    '''
+    def __init__(self, pbar=None, log=None, jsonl=None, interval=0.5):
+        from time import monotonic
+        self.pbar = pbar
+        self.log = log
+        self._own = isinstance(jsonl, (str, Path))
+        self.jsonl = open(jsonl, 'at') if self._own else jsonl
+        self.interval = interval
+        self.E_goal, self.Es, self.xscale = 0, 1, None
+        self.n = self.i = self.k = self.r = 0
+        self.w = self.alpha = self.e_star = 0
+        self.w_sum, self.w_cnt = 0, 0
+        self.emitted = 0
+        self._t0 = monotonic()
+        self._last = None
+        self._phase = None
+
+    def start(self, E_goal, Es, xscale=None):
+        '''Set the target energy distribution and the amplitude correction array'''
+        self.E_goal, self.Es, self.xscale = E_goal, Es, xscale
+
+    def update(self, **kwargs):
+        '''Set the state attributes (n, i, k, w, alpha, r, e_star, xscale)'''
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def add_width(self, w):
+        '''Add the width to the running mean'''
+        self.w_sum += w
+        self.w_cnt += 1
+
+    def reset_width(self):
+        '''Clear the running mean of the width (e.g. at the end of the burn-in)'''
+        self.w_sum, self.w_cnt = 0, 0
+
+    def state(self):
+        return {'time': self._now() - self._t0,
+                'phase': 'burn-in' if self.i == 0 else 'sampling',
+                'n': int(self.n), 'i': int(self.i), 'k': int(self.k), 'rej': int(self.r),
+                'w': float(self.w),
+                'w_mean': float(self.w_sum/self.w_cnt if self.w_cnt else self.w),
+                'alpha': float(self.alpha),
+                'dE': float((self.e_star - self.E_goal)/self.Es),
+                'acc': self.i/self.n if self.n else 0,
+                'xs': float(sqrt(self.xscale.std())) if self.xscale is not None else 1.0}
+
+    def _now(self):
+        from time import monotonic
+        return monotonic()
+
+    def emit(self, force=False):
+        '''
+        Write the state to the outputs if the `interval` passed since the
+        last output (or the phase changed). Returns True if written.
+        '''
+        if self.pbar is None and self.log is None and self.jsonl is None:
+            return False
+        now = self._now()
+        phase = self.i == 0
+        if (not force and phase == self._phase and self._last is not None
+            and now - self._last < self.interval):
+            return False
+        self._last, self._phase = now, phase
+        self.emitted += 1
+        s = self.state()
+        if self.pbar is not None:
+            if phase:
+                self.pbar.set_postfix(Sample='burn-in', n=s['k'], w=s['w'], alpha=s['alpha'],
+                                      dE=f'{s["dE"]:+6.2f} sigma', xs=f'{s["xs"]:6.3f}')
+            else :
+                self.pbar.set_postfix(xs=f'{s["xs"]:6.3f}', config=f'{s["i"]:04d}',
+                                      a=f'{100*s["acc"]:5.1f}%', w=s['w'], w_bar=f'{s["w_mean"]:7.3f}',
+                                      alpha=f'{s["alpha"]:7.1e}', rej=f'{s["rej"]:4d}')
+        if self.log is not None:
+            if phase:
+                print(f'Burn-in sample {s["xs"]:6.3f}:{s["k"]}'
+                      f'  w:{s["w"]:.4f}  alpha:{s["alpha"]:7.1e}'
+                      f'  dE:{s["dE"]:+6.2f} sigma', file=self.log)
+            else :
+                print(f'Sample {s["xs"]:6.3f}:{s["n"]:04d}'
+                      f'  a:{100*s["acc"]:5.1f}%  w:{s["w"]:.4f}  <w>:{s["w_mean"]:.4f}'
+                      f' alpha:{s["alpha"]:10.3e}  rej:{s["rej"]:d}', file=self.log)
+            self.log.flush()
+        if self.jsonl is not None:
+            import json
+            print(json.dumps(s), file=self.jsonl, flush=True)
+        return True
+
+    def close(self):
+        '''Write the final state and close the owned files'''
+        self.emit(force=True)
+        if self._own:
+            self.jsonl.close()
+
+# Cell
+class VirialAccumulator:
+    '''
+    Streaming statistics of the `(rows, 3)` arrays of virials (relative to kT).
+
+    INPUT
+    -----
+    ctx      : `StructureContext` of the structure
+    dof      : The rows are the DOF (`ctx.dof`, as in the `dofmu` array of
+               the sampler) instead of the atoms
+    bins     : Edges of the histogram bins. The values outside the range
+               are counted in the first/last bin.
+    skip     : Number of initial steps excluded from the moments and histograms
+               (but included in the history)
+    hist_len : Max. length of the history of the per-element means
+    dof_hist : Keep the histograms of the individual DOF components as well
+
+    The statistics are kept for the groups of rows: the total (group 0) and
+    the elements in `ctx.elements` order (groups 1, 2, ...). The group value
+    is the mean over its rows and directions.
+
+    Attributes
+    ----------
+    n        : Number of steps counted in the moments and histograms
+    steps    : Number of all added steps
+    mean, var: Per-row moments (`(rows, 3)` arrays)
+    counts   : Histograms of the group values (`(groups, bins)` array)
+    dof_counts: Histograms of the row components (`(rows, 3, bins)` array) or None
+    block    : Length of the block of steps averaged in one history entry
+    '''
+    def __init__(self, ctx, dof=False, bins=None, skip=0, hist_len=1024, dof_hist=False):
+        self.elements = ctx.elements
+        rowel = ctx.dofel if dof else ctx.numbers
+        if bins is None:
+            bins = np.linspace(0, 4, 401)
+        self.edges = np.asarray(bins, dtype=float)
+        nb = len(self.edges) - 1
+        # Weights of the rows in the group means
+        wg = np.vstack([np.ones(len(rowel), dtype=bool)] + [rowel == el for el in self.elements])
+        self._wg = (wg / wg.sum(axis=1)[:, None] / 3).T
+        ng = len(wg)
+        self.skip = skip
+        self.n = self.steps = 0
+        self.mean = np.zeros((len(rowel), 3))
+        self._m2 = np.zeros((len(rowel), 3))
+        self.el_sum = np.zeros(ng)
+        self.el_sum2 = np.zeros(ng)
+        self.counts = np.zeros((ng, nb), dtype=int)
+        self.dof_counts = np.zeros((len(rowel), 3, nb), dtype=int) if dof_hist else None
+        self._hist = np.zeros((hist_len, ng))
+        self._hn = 0
+        self._hsum = np.zeros(ng)
+        self._hcnt = 0
+        self.block = 1
+
+    def _bin(self, v):
+        return np.clip(np.searchsorted(self.edges, v, side='right') - 1, 0, len(self.edges) - 2)
+
+    def add(self, v):
+        '''Add the `(rows, 3)` array of virials'''
+        v = np.asarray(v)
+        g = v.sum(axis=1) @ self._wg
+        self.steps += 1
+        # Block-averaged history
+        self._hsum += g
+        self._hcnt += 1
+        if self._hcnt == self.block:
+            self._hist[self._hn] = self._hsum / self.block
+            self._hn += 1
+            self._hsum[:] = 0
+            self._hcnt = 0
+            if self._hn == len(self._hist):
+                # Full - merge the neighbouring blocks
+                h = self._hist[:self._hn // 2 * 2].reshape(-1, 2, len(g)).mean(axis=1)
+                self._hn = len(h)
+                self._hist[:self._hn] = h
+                self.block *= 2
+        if self.steps <= self.skip:
+            return
+        self.n += 1
+        d = v - self.mean
+        self.mean += d / self.n
+        self._m2 += d * (v - self.mean)
+        self.el_sum += g
+        self.el_sum2 += g**2
+        self.counts[np.arange(len(g)), self._bin(g)] += 1
+        if self.dof_counts is not None:
+            i, j = np.indices(v.shape)
+            self.dof_counts[i, j, self._bin(v)] += 1
+
+    @property
+    def var(self):
+        return self._m2 / max(self.n - 1, 1)
+
+    @property
+    def el_mean(self):
+        '''Means of the group values (total, elements)'''
+        return self.el_sum / max(self.n, 1)
+
+    @property
+    def el_std(self):
+        '''Standard deviations of the group values (total, elements)'''
+        return np.sqrt(np.maximum(self.el_sum2 / max(self.n, 1) - self.el_mean**2, 0))
+
+    def hist(self, g=0, merge=1):
+        '''
+        Probability density histogram of the group `g` with every
+        `merge` neighbouring bins joined. Returns (density, edges).
+        '''
+        c = self.counts[g]
+        c = np.pad(c, (0, -len(c) % merge)).reshape(-1, merge).sum(axis=1)
+        edges = self.edges[::merge]
+        if len(edges) == len(c):
+            edges = np.append(edges, self.edges[-1])
+        return c / max(c.sum(), 1) / np.diff(edges), edges
+
+    def history(self):
+        '''
+        History of the group means. Returns the array of the step numbers
+        of the block centers and the `(blocks, groups)` array of block means.
+        '''
+        return (np.arange(self._hn) + 0.5) * self.block, self._hist[:self._hn]
+
+# Cell
+def read_alamode_fc2(fn, cryst):
+    '''
+    Read the harmonic force constants of the supercell `cryst`
+    from the XML file `fn` written by the ALAMODE `alm` program.
+    The atoms are matched with the atoms of `cryst` by positions
+    and the contributions of the periodic images are summed.
+
+    Returns the `(3*nat, 3*nat)` force-constant matrix (eV/A^2)
+    in the order of atoms in `cryst`.
+    '''
+    from xml.etree.ElementTree import parse
+    root = parse(fn).getroot()
+    spos = np.array([[float(v) for v in p.text.split()]
+                     for p in root.find('Structure/Position').findall('pos')])
+    nat = len(spos)
+    if nat != len(cryst):
+        raise ValueError(f'Different supercell in {fn}: {nat} atoms instead of {len(cryst)}')
+    d = spos[:, None, :] - cryst.get_scaled_positions()[None, :, :]
+    d -= np.rint(d)
+    d = (d**2).sum(axis=-1)
+    amap = np.argmin(d, axis=1)
+    if d.min(axis=1).max() > 1e-6 or len(set(amap)) != nat:
+        raise ValueError(f'The structure in {fn} does not match the supercell.')
+    # Images of the primitive cell atoms under the supercell translations
+    tmap = {}
+    for m in root.find('Symmetry/Translations').findall('map'):
+        tmap.setdefault(int(m.get('tran')), {})[int(m.get('atom'))] = int(m.text) - 1
+    first = tmap[1]
+    tperm = []
+    for tr in tmap.values():
+        d = (spos + spos[tr[1]] - spos[first[1]])[:, None, :] - spos[None, :, :]
+        d -= np.rint(d)
+        tperm.append(np.argmin((d**2).sum(axis=-1), axis=1))
+    fc = np.zeros((nat, 3, nat, 3))
+    for e in root.find('ForceConstants/HARMONIC').findall('FC2'):
+        i, a = [int(v) for v in e.get('pair1').split()]
+        j, b = [int(v) - 1 for v in e.get('pair2').split()[:2]]
+        for p in tperm:
+            fc[p[first[i]], a-1, p[j], b] += float(e.text)
+    res = np.empty_like(fc)
+    r3 = np.arange(3)
+    res[np.ix_(amap, r3, amap, r3)] = fc
+    return res.reshape(3*nat, 3*nat) * un.Ry / un.Bohr**2
+
+# Cell
+def _symmetrize_fc(m, ops):
+    '''
+    Average the `(3*nat, 3*nat)` matrix `m` over the symmetry
+    operations `ops` = (carthesian rotations, atom permutations).
+    '''
+    crot, perm = ops
+    nat = perm.shape[1]
+    # 3x3 blocks of the atom pairs
+    m = m.reshape(nat, 3, nat, 3).transpose(0, 2, 1, 3)
+    s = np.zeros_like(m)
+    for r, p in zip(crot, perm):
+        s[p[:, None], p[None, :]] += r @ m @ r.T
+    return (s / len(crot)).transpose(0, 2, 1, 3).reshape(3*nat, 3*nat)
+
+def fit_force_constants(smpl, ctx=None):
+    '''
+    Least-squares fit of the harmonic force constants to the samples.
+
+    INPUT
+    -----
+    smpl : List of samples `(n, i, x, f, e)`, e.g. read from the DFSET
+           file of a previous run with `DFSETIndex`.
+    ctx  : `StructureContext` of the supercell. If given, all symmetry
+           images of the samples are included in the fit (without
+           generating them) and the result has the full symmetry.
+
+    OUTPUT
+    ------
+    The `(3*nat, 3*nat)` force-constant matrix (eV/A^2).
+    '''
+    X = np.array([s[2].ravel() for s in smpl])
+    F = np.array([s[3].ravel() for s in smpl])
+    A, B = X.T @ X, F.T @ X
+    if ctx is not None:
+        ops = ctx.operations(unique_rotations=False)
+        A, B = _symmetrize_fc(A, ops), _symmetrize_fc(B, ops)
+    fc = -B @ np.linalg.pinv(A, hermitian=True)
+    return (fc + fc.T)/2
+
+# Cell
+class NormalModeProposal:
+    '''
+    Proposal distribution of the displacements at the temperature `T` (K)
+    in the eigenbasis of the force-constant matrix `fc` (`(3*nat, 3*nat)`
+    array in eV/A^2, see `read_alamode_fc2` and `fit_force_constants`).
+    The rigid translations of the supercell are excluded. The modes
+    softer than `soft` times the median stiffness of the stable modes
+    (including the unstable ones) get the amplitude of the mode with
+    this stiffness.
+    Calling the object returns the random `(nat, 3)` displacement.
+
+    Attributes
+    ----------
+    modes     : `(3*nat, nmodes)` array of the eigenvectors
+    stiffness : Eigenvalues of the modes (eV/A^2)
+    amp       : Harmonic amplitudes of the modes at `T` (A)
+    '''
+    def __init__(self, fc, T, soft=0.05):
+        fc = np.asarray(fc)
+        n = len(fc)
+        self.shape = (n//3, 3)
+        self.T = T
+        # Orthonormal basis of the complement of the rigid translations
+        tr = np.tile(np.eye(3), n//3).T
+        q = np.linalg.qr(tr, mode='complete')[0][:, 3:]
+        self.stiffness, w = np.linalg.eigh(q.T @ ((fc + fc.T)/2) @ q)
+        self.modes = q @ w
+        stable = self.stiffness > 0
+        if not stable.any():
+            raise ValueError('No stable modes in the force constants')
+        kmin = soft*np.median(self.stiffness[stable])
+        k = np.where(self.stiffness < kmin, kmin, self.stiffness)
+        self.amp = np.sqrt(un.kB*T/k)
+
+    def __call__(self):
+        return (self.modes @ (self.amp * np.random.standard_normal(len(self.amp)))).reshape(self.shape)
+
 # Cell
 def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
             N=None, w_search=True, delta_sample=0.01, sigma=2,
@@ -75,7 +1428,9 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
             Ep0=None, modify=None, modify_args=None, symprec=1e-5,
             directory=None, reuse_base=None, verb=True, pbar=None,
             priors=None, posts=None, width_list=None,
-            dofmu_list=None, xscale_list=None):
+            dofmu_list=None, xscale_list=None, ctx=None, adapt=None, supervisor=None,
+            inplace=False, w_window=None, telemetry=None, virial_acc=None, dofmu_acc=None,
+            proposal=None, start=(0, 0)):
     '''
     Run HECS sampler on the system `cryst` using calculator `calc` at target
     temperature `T_goal`. The `delta`, `width`, `maxburn` and `directory`
@@ -98,8 +1453,14 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     maxburn      : max number of burn-in steps
     N            : Number of iterations. If None (default) the generator never stops.
     w_search     : Run search for initial w. If false start from whatever
-                   is passed as width.
+                   is passed as width. If 'model' the search uses the quadratic
+                   model of the energy (see `model_width`) instead of the fixed
+                   multiplicative steps. It usually needs only a few steps.
     delta_sample : Prior width adaptation rate. The default is sufficient in most cases.
+    w_window     : If not None, the width in the sampling mode is steered towards the fit
+                   of the energy-width relation over the last `w_window` steps
+                   (see `fit_width`) instead of the `delta_sample` adaptation. Every step
+                   makes `1/w_window` of the way to the fit and the prior is re-fitted.
     sigma        : Range around E0 in sigmas to stop w-serach mode
     eqdelta      : Max. speed of amplitude correction from step to step (0.05=5%)
     eqsigma      : Half width of linear part of amplitude correction function.
@@ -114,6 +1475,17 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
                    with energy of the structure (e, scalar) and forces (f, array).
     modify_args  : dictionary of extra arguments to pass to modify function
     symprec      : symmetry detection treshold for spglib functions
+    ctx          : `StructureContext` of the structure. If None (default) it is
+                   obtained with `get_structure_context(cryst, symprec)`.
+    adapt        : `AmplitudeCorrection` object shared with other samplers. If None
+                   (default) the sampler creates its own using `xscale_init`, `eqdelta`,
+                   `eqsigma`, `xi` and `chi` parameters.
+    supervisor   : `CalcSupervisor` running the calculations. If None (default)
+                   the failed calculation is only counted and the new displacement
+                   is generated. The failure statistics are in its `stats` attribute.
+    inplace      : Low-overhead mode for large cells and fast calculators. Uses
+                   preallocated buffers and in-place updates. The generated samples
+                   are the same as in the default mode.
     directory    : (only for VASP calculator) directory for calculations and generated samples.
                    If left as None, the `calc/{T_goal:.1f}K/` will be used and the generated
                    samples will be stored in the `smpl/{i:04d}` subdirectories.
@@ -124,7 +1496,17 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
                    in calc and reuse_base, otherwise the ground state energy and distribution
                    will be wrong.
     verb         : print verbose progress messages for interactive use
-    pbar         : tqdm progress bar object. If None (default) there will be no output.
+    pbar         : tqdm progress bar object. If None (default) the progress is printed,
+                   if False there will be no output.
+    telemetry    : `Telemetry` object reporting the progress. If None (default)
+                   it is created for the `pbar` (or printing) with default interval.
+    proposal     : Callable returning the random `(nat, 3)` displacement distributed
+                   as at T_goal (e.g. `NormalModeProposal`). If None (default) the
+                   independent gaussian displacements of the heuristic width are used.
+                   The width and the amplitude correction are applied on top of it.
+    start        : Numbers of the sample and config preceding the run (e.g. the last
+                   of the samples reused from the `SampleBank`). The samples are numbered
+                   from `start[0]+1`, the configs (and `smpl` subdirectories) from `start[1]`.
 
     **Output parameters**
 
@@ -136,6 +1518,10 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     xscale_list  : Output parameter. If not None, store in passed list the array of amplitude
                    correction coefficients (normalized). May be used to generate `xscale_init`
                    values with the help of `calc_init_xscale` function.
+    virial_acc   : Output parameter. If not None, the `VirialAccumulator` updated with
+                   the virials of the generated samples relative to temperature (T_goal).
+    dofmu_acc    : Output parameter. If not None, the `VirialAccumulator` (with `dof=True`)
+                   updated with the DOF virials (the streaming version of `dofmu_list`).
 
     OUTPUT
     ------
@@ -150,35 +1536,15 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     - energy       : potential energy of the configuration
 
     '''
+    from scipy import stats
+    from scipy.special import expit
+    from ase.calculators import calculator
 
-    if pbar:
+    # The bool() of tqdm without total raises error - test the identity
+    show_pbar = pbar is not None and pbar is not False
+    if show_pbar:
         pbar.set_postfix(Sample='initial')
 
-    def smpl_print(r=0):
-        max_r = 15
-        if pbar:
-            if i==0:
-                pbar.set_postfix(Sample='burn-in', n=k, w=w, alpha=alpha,
-                                 dE=f'{(e_star-E_goal)/Es:+6.2f} sigma',
-                                 xs=f'{sqrt(xscale.std()):6.3f}')
-            else :
-                pbar.set_postfix(xs=f'{sqrt(xscale.std()):6.3f}', config=f'{i:04d}', a=f'{100*i/n:5.1f}%',
-                                 w=w, w_bar=f'{np.mean([_[0] for _ in wl]) if wl else w:7.3f}',
-                                 alpha=f'{alpha:7.1e}', rej=f'{r:4d}')
-        elif pbar is None :
-            if i==0:
-                print(f'Burn-in sample {sqrt(xscale.std()):6.3f}:{k}'
-                      f'  w:{w:.4f}  alpha:{alpha:7.1e}'
-                      f'  dE:{(e_star-E_goal)/Es:+6.2f} sigma', end='\n')
-            else :
-                print(f'Sample {sqrt(xscale.std()):6.3f}:{n:04d}'
-                      f'  a:{100*i/n:5.1f}%  w:{w:.4f}  <w>:{np.mean([_[0] for _ in wl]) if wl else w:.4f}'
-                      f' alpha:{alpha:10.3e}  rej:{r:d}', end='\n')
-            sys.stdout.flush()
-        else :
-            pass
-
-
     def print_xs(c, s):
         elmap = c.get_atomic_numbers()
         for el in sorted(set(elmap)):
@@ -189,31 +1555,24 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     nat = len(cryst)
     dim = (nat, 3)
 
-    symm = get_symmetry_dataset(cryst, symprec=symprec)
-    dofmap = symm['mapping_to_primitive']
-    dof = list(sorted(set(dofmap)))
-    dofmu = np.ones((len(dof), 3))
+    if ctx is None:
+        ctx = get_structure_context(cryst, symprec)
+    dofmu = np.ones((len(ctx.dof), 3))
     mu = np.ones(dim)
 
-    if xscale_init is None:
-        xscale = np.ones(dim)
-    else :
-        xscale = np.array(xscale_init)
-        assert xscale.shape == dim
-
-    # Initialise dofxs from data passed in xscale_init
-    dofxs = np.array([xscale[dofmap==d,:].mean(axis=0) for d in dof])
-    assert dofxs.shape == dofmu.shape
-
-    xi = max(0,xi)
-    xi = min(1,xi)
-
-    assert 0 <= xi <= 1
+    if supervisor is None:
+        supervisor = CalcSupervisor()
 
-    chi = max(0,chi)
-    chi = min(1,chi)
-
-    assert 0 <= chi <= 1
+    if adapt is None:
+        adapt = AmplitudeCorrection(ctx, xscale_init, eqdelta=eqdelta, eqsigma=eqsigma,
+                                    xi=xi, chi=chi, inplace=inplace)
+    xscale = adapt.xscale
+    pos0 = cryst.get_positions()
+    if inplace:
+        posbuf = np.empty(dim)
+        mubuf = np.empty(dim)
+        virbuf = np.empty(dim)
+    assert adapt.dofxs.shape == dofmu.shape
 
     if Ep0 is None:
         if reuse_base is not None:
@@ -225,28 +1584,39 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     E_goal = 3*T_goal*un.kB/2
     Es = np.sqrt(3/2)*un.kB*T_goal/np.sqrt(nat)
 
+    if telemetry is None:
+        telemetry = Telemetry(pbar=pbar if show_pbar else None, log=sys.stdout if pbar is None else None)
+    tel = telemetry
+    tel.start(E_goal, Es, xscale)
+
     P = stats.norm.pdf
     Q = stats.norm
+    if inplace:
+        # Plain scalar normal pdf - avoids the scipy.stats call overhead
+        def P(x, loc=0, scale=1):
+            return exp(-((x - loc)/scale)**2/2)/sqrt(2*np.pi)/scale
 
     # This comes from the fitting to 3C-SiC case
     w_scale = 1.667e-3 * (T_goal**0.5) #(T_goal**0.47)
 
     w = width
     w_prev = w
+    # Previous point of the model-based w-search
+    ws_prev, es_prev = np.nan, np.nan
 
     if width_list is None :
         wl = []
     else :
         wl = width_list
 
+    # Keep only the energies of the priors if they are not requested
+    full_priors = priors is not None
     if priors is None:
         priors = []
 
-    if posts is None:
-        posts = []
-
     i = 0
-    n = 0
+    n0, i0 = start
+    n = n0
 
     if directory is None :
         basedir = f'calc/T_{T_goal:.1f}K'
@@ -259,7 +1629,7 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
                    pbc=True, calculator=calc)
 
     try :
-        cr.calc.set(directory=f'{basedir}/smpl/{i:04d}')
+        cr.calc.set(directory=f'{basedir}/smpl/{i+i0:04d}')
     except AttributeError :
         # Calculator is not directory-based
         # Ignore the error
@@ -276,40 +1646,60 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
     prior_len=0
     pfit = None
 
-    if pbar:
+    if show_pbar:
         pbar.set_postfix(Sample='burn-in')
 
     while True:
 
         # print_xs(cryst, xscale)
         #x_star =  Q.rvs(size=dim, scale=w * w_scale * xscale)
-        x_star = xscale * Q.rvs(size=dim, scale=w * w_scale)
+        xscale = adapt.xscale
+        if proposal is not None:
+            # Harmonic displacement at T_goal (a new array)
+            x_star = proposal()
+            x_star *= w
+            x_star *= xscale
+        elif inplace:
+            # The same random numbers and operations as Q.rvs below.
+            # The x_star array is stored in the sample, thus it is not reused.
+            x_star = np.random.standard_normal(dim)
+            x_star *= w * w_scale
+            x_star *= xscale
+        else :
+            x_star = xscale * Q.rvs(size=dim, scale=w * w_scale)
 
         assert x_star.shape == dim
 
         if verb and (n>0 or k>0):
-            smpl_print(r)
+            tel.emit()
 
-        cr.set_positions(cryst.get_positions()+x_star)
+        cr.set_positions(np.add(pos0, x_star, out=posbuf) if inplace else pos0 + x_star)
         try :
-            cr.calc.set(directory=f'{basedir}/smpl/{i:04d}')
+            cr.calc.set(directory=f'{basedir}/smpl/{i+i0:04d}')
         except AttributeError :
             pass
 
-        try :
+        def compute():
             if modify is not None:
-                e_star, f_star = modify(cr, cryst, 's', *modify_args)
+                return modify(cr, cryst, 's', *modify_args)
             else:
-                e_star = cr.get_potential_energy()
-                f_star = cr.get_forces()
+                return cr.get_potential_energy(), cr.get_forces()
+
+        try :
+            e_star, f_star = supervisor(cr.calc, compute, f'{basedir}/smpl/{i+i0:04d}')
         except calculator.CalculatorError:
-            print(f"Calculator in {cr.calc.directory} faild.\n", file=sys.stderr)
+            if supervisor.exhausted:
+                print(f'\nError: reached the limit of failed calculations '
+                      f'({supervisor.max_abandoned}). Stopping.', file=sys.stderr)
+                return
             print("Ignoring. Generating next displacement.", file=sys.stderr)
             continue
 
         e_star = (e_star-Ep0)/nat
 
         wl.append((w,e_star))
+        tel.add_width(w)
+        tel.update(w=w, e_star=e_star)
 
         if i==0 :
             # w-search mode
@@ -321,26 +1711,17 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
         w_prev = w
 
         # Equilibrate all degrees of freedom
-        mu = np.abs(f_star*x_star)/(un.kB*T_goal)
+        if inplace:
+            mu = np.multiply(f_star, x_star, out=mubuf)
+            np.abs(mu, out=mu)
+            mu /= un.kB*T_goal
+        else :
+            mu = np.abs(f_star*x_star)/(un.kB*T_goal)
         # mu = np.abs(f_star*x_star)/(np.abs(f_star*x_star).mean())
 
-        # Avarage mu over images of the atom in the P.U.C.
-        dofmu = np.array([mu[dofmap==d,:].mean(axis=0) for d in dof])
-
-        # We use sqrt(mu) since the energy is quadratic in position
-        # eqdelta = 0.05 => 5% maximum change in xscale from step to step
-        # eqsigma = 0.2 => half width/sharpness of the sigmoid,
-        #                  roughly linear part of the curve
-        dofxs *= (1-2*eqdelta*(expit((np.sqrt(dofmu)-1)/eqsigma)-0.5))
-
-        # We need to normalize to unchanged energy ~ xs**2
-        # The scale must be back linear in xs, thus sqrt(<xs>)
-        dofxs /= np.sqrt((dofxs**2).mean())
-
-        xscale = (chi * dofxs[dofmap] + xscale * (1 - chi))
-
-        # mix with unity: (xi*xs + (1-xi)*1), 0 < xi < 1
-        xscale = (xi*xscale + np.ones(dim) - xi)
+        # Update the (possibly shared) amplitude correction
+        dofmu = adapt.update(mu)
+        xscale = adapt.xscale
 
         if xscale_list is not None:
             xscale_list.append(np.array(xscale))
@@ -348,12 +1729,28 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
         if dofmu_list is not None:
             dofmu_list.append(np.array(dofmu))
 
+        if dofmu_acc is not None:
+            dofmu_acc.add(dofmu)
+
         if w_search :
-            w = w*(1-2*delta*(expit((e_star-E_goal)/Es/3)-0.5))
+            if i==0 and w_search == 'model':
+                w, ws_prev, es_prev = model_width(w, e_star, E_goal, ws_prev, es_prev), w, e_star
+            elif i>0 and w_window and len(wl) > 2:
+                # Sampling mode - steer the prior towards the fit over the window.
+                # The fits of the consecutive windows are averaged over the window
+                # length (the noisy fits are damped)
+                w_new = w + (fit_width(wl[-w_window:], E_goal, w) - w)/w_window
+                if w_new != w:
+                    # Different proposal - the prior is re-fitted on this step
+                    prior_len = 0
+                w = w_new
+            else :
+                w = w*(1-2*delta*(expit((e_star-E_goal)/Es/3)-0.5))
             if i==0 and abs(e_star-E_goal) > sigma*Es :
                 # We are in w-search mode but still far from E_goal
                 # Continue
                 k += 1
+                tel.update(k=k, w=w, xscale=xscale)
                 if k>maxburn :
                     print(f'\nError: reached maxburn ({maxburn}) without finding target energy.\n'+
                         f'You probably need to change initial width parameter (current:{w})' +
@@ -363,7 +1760,7 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
                 # print(f'{w=} ({abs(e_star-E_goal)/(sigma*Es)}). Continue searching')
                 continue
 
-        priors.append((n, i, x_star, f_star, e_star))
+        priors.append((n, i+i0, x_star, f_star, e_star) if full_priors else (n, i+i0, None, None, e_star))
 
         if i==0 :
             # We are in w-search mode and just found a proper w
@@ -372,6 +1769,7 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
             alpha = 2
             # clean up the w table
             wl.clear()
+            tel.reset_width()
             prior_len=1
         else :
             # Sampling mode
@@ -389,7 +1787,7 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
 
                 assert pfit is not None
                 # Take into account estimated transition probability
-                alpha *= Q.pdf(e, *pfit)/Q.pdf(e_star, *pfit)
+                alpha *= P(e, *pfit)/P(e_star, *pfit)
 
 
         if np.random.rand() < alpha:
@@ -404,25 +1802,88 @@ def HECSS_Sampler(cryst, calc, T_goal, width=1, maxburn=20,
 
         n += 1
 
-        smpl_print(r)
-        if pbar:
+        tel.update(n=n-n0, i=i, r=r, w=w, alpha=alpha, xscale=xscale)
+        tel.emit()
+        if show_pbar:
             pbar.update()
 
         if posts is not None :
-            posts.append((n, i-1, x, f, e))
+            posts.append((n, i-1+i0, x, f, e))
 
-        yield n, i-1, x, f, e
+        if virial_acc is not None:
+            if inplace:
+                vir = np.multiply(x, f, out=virbuf)
+                np.abs(vir, out=vir)
+                vir /= un.kB*T_goal
+            else :
+                vir = np.abs(x*f)/(un.kB*T_goal)
+            virial_acc.add(vir)
+
+        yield n, i-1+i0, x, f, e
 
-        if N is not None and n > N:
+        if N is not None and n - n0 > N:
             break
 
-    if pbar:
+    tel.close()
+    if show_pbar:
         pbar.close()
 
+# Cell
+def model_width(w, e, E_goal, w_prev=np.nan, e_prev=np.nan, maxstep=3):
+    '''
+    Width for the next step of the model-based w-search.
+
+    INPUT
+    -----
+    w, e          : Current width and the energy obtained with it
+    E_goal        : Target energy
+    w_prev, e_prev: Previous point of the search (NaN - no previous point)
+    maxstep       : Max. factor of the width change in one step
+
+    The energy is modelled as linear in `w**2`. Without the previous point
+    (or if the points are too close or give the non-physical slope) the line
+    goes through the origin (harmonic model), otherwise the secant step through
+    both points is made. Works elementwise on arrays (many chains at once).
+    '''
+    u, up = w**2, w_prev**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Harmonic model e = a w^2
+        unew = np.where(e > 0, u*E_goal/e, u*maxstep**2)
+        # Secant step through the last two points
+        slope = (e - e_prev)/(u - up)
+        sec = u + (E_goal - e)/slope
+        ok = np.isfinite(slope) & (slope > 0) & (sec > 0) & (np.abs(u - up) > 0.1*u)
+        unew = np.where(ok, sec, unew)
+    return np.clip(np.sqrt(unew), w/maxstep, w*maxstep)
+
+# Cell
+def fit_width(wl, E_goal, w):
+    '''
+    Width giving the mean energy of the prior equal to `E_goal` according
+    to the fit of the energy-width relation to the `(w, e)` pairs in `wl`.
+    The energy is fitted as linear in `w**2` if the widths are spread enough,
+    otherwise the harmonic model `e = a w**2` is used. Returns `w` if the
+    fit is not possible.
+    '''
+    ws, es = np.array(wl, dtype=float).T
+    u = ws**2
+    if np.ptp(u) > 0.2*u.mean():
+        a, b = np.polyfit(u, es, 1)
+        if a > 0 and E_goal > b:
+            return np.sqrt((E_goal - b)/a)
+    if es.mean() > 0:
+        return np.sqrt(E_goal*u.mean()/es.mean())
+    return w
+
 # Cell
 class HECSS:
     '''
     Class facilitating more traditional use of the `HECSS_Sampler` generator.
+    If the `SampleBank` is passed in the `bank` parameter, the first call
+    of `generate` starts with the samples drawn from the bank (their number
+    is stored in the `reused` attribute). If the `SampleStore` is passed in
+    the `store` parameter, the generated samples are appended to it and
+    `generate` returns the store instead of the new list.
     '''
     def __init__(self, cryst, calc, T_goal, width=1, maxburn=20,
                  N=None, w_search=True, delta_sample=0.01, sigma=2,
@@ -431,30 +1892,53 @@ class HECSS:
                  Ep0=None, modify=None, modify_args=None,
                  directory=None, reuse_base=None, verb=True,
                  pbar=True, priors=None, posts=None, width_list=None,
-                 dofmu_list=None, xscale_list=None):
+                 dofmu_list=None, xscale_list=None, symprec=1e-5, ctx=None,
+                 supervisor=None, inplace=False, bank=None, w_window=None, telemetry=None,
+                 virial_acc=None, dofmu_acc=None, store=None, proposal=None):
         if pbar is True:
+            from tqdm.auto import tqdm
             self.pbar = tqdm(total=N)
         else:
             self.pbar = pbar
         self.N=N
         self.total_N=0
         self.T=T_goal
-        self.sampler = HECSS_Sampler(cryst, calc, T_goal,
-                                     width=width, maxburn=maxburn,
-                                     w_search=w_search,
-                                     delta_sample=delta_sample,
-                                     sigma=sigma,
-                                     eqdelta=eqdelta, eqsigma=eqsigma,
-                                     xi=xi, chi=chi,
-                                     xscale_init=xscale_init,
-                                     Ep0=Ep0, modify=modify, modify_args=modify_args,
-                                     pbar=self.pbar,
-                                     directory=directory,
-                                     reuse_base=reuse_base, verb=verb,
-                                     priors=priors, posts=posts,
-                                     width_list=width_list,
-                                     dofmu_list=dofmu_list,
-                                     xscale_list=xscale_list)
+        self.bank = bank
+        self.reused = 0
+        self.store = store
+        if telemetry is None:
+            show_pbar = self.pbar is not None and self.pbar is not False
+            telemetry = Telemetry(pbar=self.pbar if show_pbar else None,
+                                  log=sys.stdout if self.pbar is None else None)
+        self.telemetry = telemetry
+        self.supervisor = CalcSupervisor() if supervisor is None else supervisor
+        self._sampler_args = (cryst, calc, T_goal)
+        self._sampler_kwargs = dict(width=width, maxburn=maxburn,
+                                    w_search=w_search,
+                                    delta_sample=delta_sample,
+                                    sigma=sigma,
+                                    eqdelta=eqdelta, eqsigma=eqsigma,
+                                    xi=xi, chi=chi,
+                                    xscale_init=xscale_init,
+                                    Ep0=Ep0, modify=modify, modify_args=modify_args,
+                                    pbar=self.pbar,
+                                    directory=directory,
+                                    reuse_base=reuse_base, verb=verb,
+                                    priors=priors, posts=posts,
+                                    width_list=width_list,
+                                    dofmu_list=dofmu_list,
+                                    xscale_list=xscale_list,
+                                    symprec=symprec, ctx=ctx,
+                                    supervisor=self.supervisor,
+                                    inplace=inplace, w_window=w_window,
+                                    telemetry=self.telemetry,
+                                    virial_acc=virial_acc, dofmu_acc=dofmu_acc,
+                                    proposal=proposal)
+        # With the bank the sampler continues the numbering of the reused samples
+        self.sampler = None if bank is not None else self._make_sampler()
+
+    def _make_sampler(self, start=(0, 0)):
+        return HECSS_Sampler(*self._sampler_args, start=start, **self._sampler_kwargs)
 
     def generate(self, N=None, sentinel=None, **kwargs):
         '''
@@ -468,7 +1952,9 @@ class HECSS:
         *after* generating each sample (i.e. first time after
         first sample is produced). This may take considerable
         time at the start since first initial and burn-in
-        samples must be produced.
+        samples must be produced. The samples reused from the bank
+        are numbered as the start of the sequence and passed
+        to the sentinel as well.
         '''
         if N is None:
             N = self.N
@@ -479,16 +1965,480 @@ class HECSS:
             self.pbar.reset(self.total_N + N)
             self.pbar.update(self.total_N)
 
-        smpls = []
-        for smpl in self.sampler:
-            smpls.append(smpl)
-            if sentinel is not None and sentinel(smpl, smpls, **kwargs):
+        smpls = [] if self.store is None else self.store
+        start = len(smpls)
+        stop = False
+        if self.sampler is None:
+            # Reweighted samples of the past runs go first
+            reused = self.bank.draw(self.T, N, start=(0, 0))
+            self.reused = len(reused)
+            self.sampler = self._make_sampler((len(reused), reused[-1][1] + 1 if reused else 0))
+            for smpl in reused:
+                smpls.append(smpl)
+                if self.pbar is not None and self.pbar is not False:
+                    self.pbar.update()
+                if sentinel is not None and sentinel(smpl, smpls, **kwargs):
+                    stop = True
+                    break
+        if not stop and len(smpls) - start < N:
+            for smpl in self.sampler:
+                smpls.append(smpl)
+                if sentinel is not None and sentinel(smpl, smpls, **kwargs):
+                    break
+                if len(smpls) - start >= N:
+                    #self.pbar.close()
+                    break
+            # Show the final state
+            self.telemetry.emit(force=True)
+        self.total_N += len(smpls) - start
+        return smpls
+
+# Cell
+class HECSS_Ensemble:
+    '''
+    Ensemble of `HECSS_Sampler` walkers sharing the amplitude correction.
+
+    INPUT
+    -----
+    cryst    : ASE structure to sample
+    calc     : ASE calculator or list of calculators (one per walker).
+               The single calculator is copied for every walker.
+    T_goal   : Target temperature in Kelvin
+    walkers  : Number of walkers (default: number of calculators or 4)
+    directory: Base directory of the calculations. The walker `k` uses
+               the `{directory}/w{k:02d}` subdirectory.
+    supervisor: `CalcSupervisor` shared by the walkers (created if None)
+    **kwargs : Other parameters passed to `HECSS_Sampler`. The `xscale_init`,
+               `eqdelta`, `eqsigma`, `xi` and `chi` are used for the shared
+               `AmplitudeCorrection` object (the `adapt` attribute).
+    '''
+    def __init__(self, cryst, calc, T_goal, walkers=None, directory=None,
+                 xscale_init=None, eqdelta=0.05, eqsigma=0.2, xi=1, chi=1,
+                 symprec=1e-5, ctx=None, Ep0=None, reuse_base=None, supervisor=None,
+                 **kwargs):
+        from copy import deepcopy
+        if isinstance(calc, (list, tuple)):
+            calcs = list(calc)
+            if walkers is None:
+                walkers = len(calcs)
+            assert len(calcs) == walkers
+        else :
+            if walkers is None:
+                walkers = 4
+            calcs = [deepcopy(calc) for k in range(walkers)]
+        if directory is None :
+            directory = f'calc/T_{T_goal:.1f}K'
+        if ctx is None:
+            ctx = get_structure_context(cryst, symprec)
+        # Calculate the base energy once for all walkers
+        if Ep0 is None:
+            if reuse_base is not None:
+                Ep0 = reuse_base.get_potential_energy()
+            else:
+                Ep0 = cryst.get_potential_energy()
+        self.T = T_goal
+        self.walkers = walkers
+        self.adapt = AmplitudeCorrection(ctx, xscale_init, eqdelta=eqdelta, eqsigma=eqsigma,
+                                         xi=xi, chi=chi, pool=walkers)
+        self.supervisor = CalcSupervisor() if supervisor is None else supervisor
+        kwargs.setdefault('pbar', False)
+        self.samplers = [HECSS_Sampler(cryst, c, T_goal, directory=f'{directory}/w{k:02d}',
+                                       ctx=ctx, adapt=self.adapt, Ep0=Ep0,
+                                       supervisor=self.supervisor, **kwargs)
+                         for k, c in enumerate(calcs)]
+
+    def generate(self, N, sentinel=None, **kwargs):
+        '''
+        Generate N samples with every walker. Returns the list of lists
+        of samples generated by each walker. The `sentinel` is called as in
+        `HECSS.generate` with additional `walker` argument (walker index).
+        The calls are serialized. If it returns True all walkers are stopped.
+        '''
+        from threading import Lock, Event
+        from concurrent.futures import ThreadPoolExecutor
+
+        lock = Lock()
+        stop = Event()
+
+        def run(k):
+            smpls = []
+            if N < 1:
+                return smpls
+            for smpl in self.samplers[k]:
+                smpls.append(smpl)
+                if sentinel is not None:
+                    with lock:
+                        if sentinel(smpl, smpls, walker=k, **kwargs):
+                            stop.set()
+                if stop.is_set() or len(smpls) >= N:
+                    break
+            return smpls
+
+        with ThreadPoolExecutor(max_workers=self.walkers) as pool:
+            return list(pool.map(run, range(self.walkers)))
+
+# Cell
+class ASEBatchCalculator:
+    '''
+    Batch calculator protocol adapter for the ASE calculator `calc`
+    working on the structure `cryst`. The configurations are calculated
+    one by one with the same Atoms object.
+    '''
+    def __init__(self, cryst, calc):
+        self.atoms = ase.Atoms(cryst.get_atomic_numbers(),
+                               cell=cryst.get_cell(),
+                               scaled_positions=cryst.get_scaled_positions(),
+                               pbc=True, calculator=calc)
+
+    def calculate_batch(self, positions):
+        '''
+        Return energies `(M,)` and forces `(M, nat, 3)` of the configurations
+        in the `(M, nat, 3)` array of positions.
+        '''
+        es = np.empty(len(positions))
+        fs = np.empty(np.shape(positions))
+        for k, p in enumerate(positions):
+            self.atoms.set_positions(p)
+            es[k] = self.atoms.get_potential_energy()
+            fs[k] = self.atoms.get_forces()
+        return es, fs
+
+# Cell
+def HECSS_Batch_Sampler(cryst, calc, T_goal, chains=8, width=1, maxburn=20,
+                        N=None, w_search=True, delta_sample=0.01, sigma=2,
+                        eqdelta=0.05, eqsigma=0.2, xi=1, chi=1, xscale_init=None,
+                        Ep0=None, symprec=1e-5, ctx=None, adapt=None):
+    '''
+    Run `chains` HECS samplers in lockstep on the system `cryst` using the
+    batch calculator `calc` (or ASE calculator wrapped in `ASEBatchCalculator`)
+    at target temperature `T_goal`. The parameters have the same meaning
+    as in `HECSS_Sampler`. The amplitude correction is shared by all chains
+    (the `adapt` argument may be used to pass the `AmplitudeCorrection`
+    object). The burn-in (w-search) is run for all chains together.
+
+    This is a generator yielding the first sample and N following steps
+    (N+1 samples as `HECSS_Sampler`, infinite if N is None) as tuples
+    (number, index, displacement, forces, energy) with the shapes:
+    `()`, `(M,)`, `(M, nat, 3)`, `(M, nat, 3)`, `(M,)`. The index
+    of the chain repeats if the sample has been rejected.
+    The batch calculator may return NaN energy for the failed (or not
+    finished in time) calculations - these proposals are rejected.
+    '''
+    from scipy import stats
+    from scipy.special import expit
+
+    if not hasattr(calc, 'calculate_batch'):
+        calc = ASEBatchCalculator(cryst, calc)
+    if ctx is None:
+        ctx = get_structure_context(cryst, symprec)
+    if adapt is None:
+        adapt = AmplitudeCorrection(ctx, xscale_init, eqdelta=eqdelta, eqsigma=eqsigma,
+                                    xi=xi, chi=chi, pool=chains)
+
+    M = chains
+    nat = len(cryst)
+    dim = (nat, 3)
+    pos0 = cryst.get_positions()
+    if Ep0 is None:
+        Ep0 = calc.calculate_batch(pos0[None])[0][0]
+
+    E_goal = 3*T_goal*un.kB/2
+    Es = np.sqrt(3/2)*un.kB*T_goal/np.sqrt(nat)
+    P = stats.norm.pdf
+    # This comes from the fitting to 3C-SiC case
+    w_scale = 1.667e-3 * (T_goal**0.5)
+    w = np.full(M, float(width))
+    # Previous points of the model-based w-search
+    wprev = np.full(M, np.nan)
+    eprev = np.full(M, np.nan)
+
+    def propose(idx, delta, search=False):
+        x = adapt.xscale * np.random.normal(size=(len(idx),) + dim) * (w[idx] * w_scale)[:, None, None]
+        e, f = calc.calculate_batch(pos0 + x)
+        e = (np.asarray(e) - Ep0)/nat
+        f = np.asarray(f)
+        # Only the finished calculations are used
+        ok = np.isfinite(e)
+        if ok.any():
+            adapt.update(np.abs(f[ok]*x[ok])/(un.kB*T_goal))
+        idx = idx[ok]
+        if search and w_search == 'model':
+            wn = model_width(w[idx], e[ok], E_goal, wprev[idx], eprev[idx])
+            wprev[idx], eprev[idx] = w[idx], e[ok]
+            w[idx] = wn
+        elif w_search:
+            w[idx] *= (1-2*delta*(expit((e[ok]-E_goal)/Es/3)-0.5))
+        return x, f, e
+
+    # w-search mode for all chains, the chains stop when they find proper w
+    x = np.zeros((M,) + dim)
+    f = np.zeros((M,) + dim)
+    e = np.zeros(M)
+    todo = np.arange(M)
+    k = 0
+    while len(todo):
+        xs, fs, es = propose(todo, 10 * delta_sample, search=True)
+        found = ((np.abs(es - E_goal) <= sigma*Es) | (not w_search)) & np.isfinite(es)
+        x[todo[found]], f[todo[found]], e[todo[found]] = xs[found], fs[found], es[found]
+        todo = todo[~found]
+        k += 1
+        if len(todo) and k > maxburn:
+            print(f'\nError: reached maxburn ({maxburn}) without finding target energy'
+                  f' in {len(todo)} chains.\nYou probably need to change initial width'
+                  f' parameter (current:{w[todo].mean()}).', file=sys.stderr)
+            return
+
+    # The first samples are always accepted
+    n = 1
+    i = np.ones(M, dtype=int)
+    yield n, i-1, x, f, e
+
+    # Running sums for the normal fit of the priors
+    npri = 1
+    prior_len = 1
+    cnt = np.ones(M)
+    s1 = e.copy()
+    s2 = e**2
+    while N is None or n <= N:
+        xs, fs, es = propose(np.arange(M), delta_sample)
+        ok = np.isfinite(es)
+        npri += 1
+        cnt += ok
+        s1 += np.where(ok, es, 0)
+        s2 += np.where(ok, es, 0)**2
+        alpha = P(es, E_goal, Es) / P(e, E_goal, Es)
+        if npri > 3:
+            if npri > 1.1*prior_len:
+                # Re-fit the prior only if we get 10% more samples
+                pmu = s1/cnt
+                psd = np.sqrt(np.maximum(s2/cnt - pmu**2, 0))
+                prior_len = npri
+            # Take into account estimated transition probability
+            alpha *= P(e, pmu, psd) / P(es, pmu, psd)
+        acc = (np.random.rand(M) < alpha) & ok
+        x = np.where(acc[:, None, None], xs, x)
+        f = np.where(acc[:, None, None], fs, f)
+        e = np.where(acc, es, e)
+        i += acc
+        n += 1
+        yield n, i-1, x, f, e
+
+# Cell
+class JobArrayScheduler:
+    '''
+    Batch system driven by the shell commands (Slurm by default).
+
+    INPUT
+    -----
+    submit   : Command submitting the job array. The `{script}`, `{first}`,
+               `{last}`, `{name}` and `{directory}` fields are substituted.
+               The array indices always run from 0 (`first`) to M-1 (`last`),
+               thus the array size limits of the batch system are not
+               exceeded in long runs. The job id is the last word of the
+               command output.
+    poll     : Command printing the active (queued or running) tasks of the
+               job `{jobid}`. Empty output means the job is finished.
+    task_var : Environment variable holding the index of the array task
+    header   : Header of the job script (e.g. `#SBATCH` resource directives)
+
+    For PBS Pro use e.g. `submit='qsub -J {first}-{last} -N {name} {script}'`,
+    `poll='qselect -s QR -J -N {name}'` and `task_var='PBS_ARRAY_INDEX'`.
+    '''
+    def __init__(self, submit='sbatch --parsable --array={first}-{last} -J {name} {script}',
+                 poll='squeue -h -j {jobid} -o %i', task_var='SLURM_ARRAY_TASK_ID', header=''):
+        self.submit_cmd = submit
+        self.poll_cmd = poll
+        self.task_var = task_var
+        self.header = header
+
+    def submit(self, script, first, last, name, directory):
+        '''Submit the job array and return the job id'''
+        import subprocess
+        out = subprocess.run(self.submit_cmd.format(script=script, first=first, last=last,
+                                                    name=name, directory=directory),
+                             shell=True, check=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True,
+                             cwd=directory).stdout.split()
+        return out[-1] if out else None
+
+    def active(self, jobid, name=None):
+        '''True if some tasks of the job are still queued or running'''
+        import subprocess
+        out = subprocess.run(self.poll_cmd.format(jobid=jobid, name=name),
+                             shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        return bool(out.stdout.strip())
+
+# Cell
+class LocalScheduler:
+    '''
+    Fake batch system running the array tasks as local processes,
+    at most `workers` at once. Intended for testing and workstations.
+    '''
+    task_var = 'HECSS_TASK_ID'
+    header = ''
+
+    def __init__(self, workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.submitted = 0
+
+    def submit(self, script, first, last, name, directory):
+        import subprocess
+        self.submitted += 1
+        jobid = f'{self.submitted}'
+        self.jobs[jobid] = [self.pool.submit(subprocess.run, ['sh', str(script)], cwd=directory,
+                                             env=dict(os.environ, **{self.task_var: str(k)}))
+                            for k in range(first, last+1)]
+        return jobid
+
+    def active(self, jobid, name=None):
+        return not all(t.done() for t in self.jobs.get(jobid, []))
+
+# Cell
+class JobArrayCalculator:
+    '''
+    Batch calculator protocol implementation (see `HECSS_Batch_Sampler`)
+    calculating the configurations as the job array of the batch system.
+
+    INPUT
+    -----
+    cryst     : Structure (ASE Atoms) to be calculated
+    calc      : File-based ASE calculator (with `write_input`, `read_results`)
+    scheduler : Batch system (`JobArrayScheduler` or `LocalScheduler`)
+    directory : Run directory. Calculations go to the `smpl/NNNN`
+                subdirectories numbered consecutively across batches.
+    command   : Command running the calculation in the sample directory
+                (default: the `command` of the calculator or the one
+                configured in the environment, see `make_command`)
+    name      : Name of the job arrays
+    poll      : Interval (s) between the checks for finished tasks
+    timeout   : Max. time (s) of waiting for the tasks of one batch. The tasks
+                not finished in time are failed. None (default) - no limit.
+    partial   : Return the results of the finished tasks with NaN energies
+                and forces of the failed ones (rejected by the sampler)
+                instead of raising `CalculationFailed`.
+
+    The results are read as the tasks finish (see `results`), thus the
+    `timeout` with `partial` prevents a stuck task from holding the run.
+    The `jobs` attribute lists the submitted job ids.
+    '''
+    done_file = '.hecss_done'
+
+    def __init__(self, cryst, calc, scheduler=None, directory='.', command=None,
+                 name='hecss', poll=30, timeout=None, partial=False):
+        self.cryst = cryst
+        self.calc = calc
+        self.scheduler = JobArrayScheduler() if scheduler is None else scheduler
+        self.directory = Path(directory)
+        if command is None:
+            from ase.calculators.calculator import CalculatorSetupError
+            command = getattr(calc, 'command', None)
+            try :
+                # Command set in the environment (e.g. ASE_VASP_COMMAND)
+                command = calc.make_command(command)
+            except (AttributeError, CalculatorSetupError):
+                pass
+        if not command:
+            raise ValueError('No command to run the calculation. Pass the command '
+                             'or configure it in the calculator.')
+        self.command = command
+        self.name = name
+        self.poll = poll
+        self.timeout = timeout
+        self.partial = partial
+        self.jobs = []
+        # Skip the leftovers like smpl/0001.bak
+        dirs = [int(d.name) for d in self.directory.glob('smpl/[0-9]*') if d.name.isdigit()]
+        self.count = max(dirs) + 1 if dirs else 0
+
+    def submit(self, positions):
+        '''
+        Write the inputs for the `(M, nat, 3)` array of positions and submit
+        them as a job array. Returns the job id and the list of directories.
+        '''
+        from ase.calculators.calculator import all_changes
+        first = self.count
+        dirs = []
+        for p in positions:
+            d = self.directory / 'smpl' / f'{self.count:04d}'
+            a = self.cryst.copy()
+            a.set_positions(p)
+            self.calc.directory = str(d)
+            self.calc.write_input(a, ['energy', 'forces'], all_changes)
+            dirs.append(d)
+            self.count += 1
+        script = self.directory / f'{self.name}_{first:04d}.sh'
+        # Array task k calculates the sample first+k
+        task = '$((${' + self.scheduler.task_var + '} + ' + f'{first}))'
+        with open(script, 'wt') as sf:
+            sf.write('#!/bin/sh\n' + self.scheduler.header + '\n'
+                     f'cd "{self.directory.absolute()}/smpl/$(printf %04d {task})" || exit 1\n'
+                     f'{self.command}\n'
+                     f'echo $? > {self.done_file}\n')
+        jobid = self.scheduler.submit(script.absolute(), 0, len(dirs) - 1,
+                                      self.name, self.directory.absolute())
+        self.jobs.append(jobid)
+        return jobid, dirs
+
+    def results(self, jobid, dirs):
+        '''
+        Generator yielding `(k, energy, forces)` for the configurations
+        of the submitted batch as their calculations are finished.
+        Raises `CalculationFailed` if some tasks failed, were not finished
+        within `timeout` or the job disappeared from the queue leaving
+        unfinished tasks.
+        '''
+        from time import sleep, monotonic
+        from ase.calculators.calculator import CalculationFailed
+        todo = dict(enumerate(dirs))
+        failed = []
+        t0 = monotonic()
+        while todo:
+            # Check the queue before the files - no finished task is missed
+            active = self.scheduler.active(jobid, self.name)
+            for k, d in list(todo.items()):
+                try :
+                    status = int((d / self.done_file).read_text())
+                except (FileNotFoundError, ValueError):
+                    continue
+                del todo[k]
+                if status:
+                    failed.append(str(d))
+                    continue
+                self.calc.directory = str(d)
+                self.calc.atoms = self.cryst.copy()
+                self.calc.read_results()
+                yield k, self.calc.results['energy'], self.calc.results['forces']
+            if todo and not active:
+                failed += [str(d) for d in todo.values()]
                 break
-            if len(smpls) >= N:
-                #self.pbar.close()
+            if todo and self.timeout is not None and monotonic() - t0 > self.timeout:
+                failed += [f'{d} (timed out)' for d in todo.values()]
                 break
-        self.total_N += len(smpls)
-        return smpls
+            if todo:
+                sleep(self.poll)
+        if failed:
+            raise CalculationFailed(f'Failed calculations in job {jobid}: {", ".join(failed)}')
+
+    def calculate_batch(self, positions):
+        '''
+        Return energies `(M,)` and forces `(M, nat, 3)` of the configurations
+        in the `(M, nat, 3)` array of positions calculated as one job array.
+        With `partial` the failed calculations have NaN values (the error
+        is raised only if all of them failed).
+        '''
+        from ase.calculators.calculator import CalculationFailed
+        es = np.full(len(positions), np.nan)
+        fs = np.full(np.shape(positions), np.nan)
+        try :
+            for k, e, f in self.results(*self.submit(positions)):
+                es[k], fs[k] = e, f
+        except CalculationFailed:
+            if not self.partial or np.isnan(es).all():
+                raise
+        return es, fs
 
 # Internal Cell
 
@@ -515,6 +2465,242 @@ def select_asap_model(comp='SiC'):
         model = None
     return model
 
+# Cell
+def autocorrelation(x):
+    '''
+    Normalized autocorrelation function of the sequence `x` calculated
+    with the FFT. The first axis of `x` is the sequence (step) axis.
+    For multidimensional arrays (e.g. the `(steps, nat, 3)` history of
+    virials) the functions of all components are calculated at once.
+    '''
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    ft = np.fft.rfft(x - x.mean(axis=0), n=2*n, axis=0)
+    acf = np.fft.irfft(ft * np.conj(ft), axis=0)[:n]
+    # Constant components are fully correlated
+    const = acf[0] <= 0
+    return np.where(const, 1.0, acf/np.where(const, 1.0, acf[0]))
+
+def autocorr_time(x, c=5):
+    '''
+    Integrated autocorrelation time of the sequence `x` (along the first axis).
+    The sum is truncated with the automatic windowing procedure
+    of Sokal (the smallest window M with M >= c*tau(M)).
+    '''
+    taus = 2*np.cumsum(autocorrelation(x), axis=0) - 1
+    m = np.arange(len(taus)).reshape((-1,) + (1,)*(taus.ndim-1)) < c * taus
+    # First lag where the window condition fails or the last one
+    w = np.where(m.all(axis=0), len(taus)-1, np.argmin(m, axis=0))
+    return np.take_along_axis(taus, w[None], axis=0)[0]
+
+def effective_sample_size(x, c=5):
+    '''
+    Effective sample size of the sequence `x` (along the first axis):
+    N/tau where tau is the integrated autocorrelation time.
+    '''
+    return len(x)/np.maximum(autocorr_time(x, c), 1)
+
+# Cell
+class ConvergenceSentinel:
+    '''
+    Sentinel for `HECSS.generate` stopping the sampling when the
+    online convergence criteria are met:
+
+    INPUT
+    -----
+    cryst       : ASE structure being sampled
+    T_goal      : Target temperature in Kelvin
+    min_ess     : Minimal effective sample size of the energies
+    pvalue      : Minimal p-value of the KS test against the target
+                  distribution (used with `test='ks'`)
+    test        : 'ks' (Kolmogorov-Smirnov) or 'ad' (Anderson-Darling)
+    max_ad      : Maximal AD statistic (used with `test='ad'`),
+                  the default is the 5% critical value for the
+                  fully specified distribution.
+    vir_tol     : Maximal relative change of the per-element virials
+                  over the last `window` samples
+    window      : Window for the virial stabilisation criterion
+    min_samples : Never stop before that number of samples
+    sentinel    : Other sentinel to call before the convergence check
+                  (e.g. `dfset_writer`). If it returns True the iteration
+                  is stopped as well.
+    verb        : Print the convergence state when the sampling is stopped
+    ctx         : `StructureContext` of the structure (created if None)
+
+    The last calculated diagnostics are stored in the `state` attribute.
+    '''
+    def __init__(self, cryst, T_goal, min_ess=100, pvalue=0.05, test='ks',
+                 max_ad=2.492, vir_tol=0.02, window=50, min_samples=20,
+                 sentinel=None, verb=False, ctx=None):
+        assert test in ('ks', 'ad')
+        self.T = T_goal
+        self.nat = len(cryst)
+        self.ctx = get_structure_context(cryst) if ctx is None else ctx
+        self.elems = self.ctx.elements
+        self.E_goal = 3*T_goal*un.kB/2
+        self.Es = np.sqrt(3/2)*un.kB*T_goal/np.sqrt(self.nat)
+        self.min_ess = min_ess
+        self.pvalue = pvalue
+        self.test = test
+        self.max_ad = max_ad
+        self.vir_tol = vir_tol
+        self.window = window
+        self.min_samples = max(min_samples, window + 1)
+        self.sentinel = sentinel
+        self.verb = verb
+        self.es = []
+        self.vir = []
+        self.state = {}
+
+    def check(self):
+        '''
+        Calculate the diagnostics and return True if the chain is converged.
+        '''
+        from scipy import stats
+        es = np.array(self.es)
+        n = len(es)
+        tau = max(autocorr_time(es), 1)
+        ess = n/tau
+        # Thin the chain to get roughly independent samples for the test
+        z = np.sort((es[::int(np.ceil(tau))] - self.E_goal)/self.Es)
+        if self.test == 'ks':
+            gof = stats.kstest(z, 'norm').pvalue
+            gof_ok = gof >= self.pvalue
+        else :
+            m = len(z)
+            cdf = np.clip(stats.norm.cdf(z), 1e-15, 1-1e-15)
+            k = np.arange(1, m+1)
+            gof = -m - ((2*k-1)*(np.log(cdf) + np.log(1-cdf[::-1]))).sum()/m
+            gof_ok = gof <= self.max_ad
+        vir = np.cumsum(self.vir, axis=0)/np.arange(1, n+1)[:,None]
+        dvir = np.abs(vir[-1]/vir[-1-self.window] - 1)
+        self.state = {'n': n, 'tau': float(tau), 'ess': float(ess), self.test: float(gof),
+                      'dvir': {chemical_symbols[el]: float(d) for el, d in zip(self.elems, dvir)}}
+        return ess >= self.min_ess and gof_ok and (dvir <= self.vir_tol).all()
+
+    def __call__(self, s, sl, **kwargs):
+        if self.sentinel is not None and self.sentinel(s, sl, **kwargs):
+            return True
+        n, i, x, f, e = s
+        mu = np.abs(x*f)/(un.kB*self.T)
+        self.es.append(e)
+        self.vir.append(self.ctx.el_mean(mu))
+        if len(self.es) < self.min_samples:
+            return False
+        if self.check():
+            if self.verb:
+                print(f'\nConverged after {len(self.es)} samples: ', self.state)
+            return True
+        return False
+
+# Cell
+class SampleBus:
+    '''
+    Deliver the samples to the `consumers` on the background thread.
+    The object is a sentinel for `HECSS.generate` (it never stops the
+    iteration) and may be chained in `ConvergenceSentinel`.
+
+    consumers : callables with the signature of the sentinel `c(s, sl, **kwargs)`
+    maxsize   : Size of the queue of samples waiting for the consumers
+
+    The exceptions raised by the consumers are reported on stderr and
+    stored in the `errors` list as `(sample number, consumer, exception)`.
+    '''
+    def __init__(self, *consumers, maxsize=64):
+        from queue import Queue
+        self.consumers = list(consumers)
+        self.samples = []
+        self.errors = []
+        self._queue = Queue(maxsize)
+        self._thread = None
+
+    def register(self, consumer):
+        '''
+        Add the consumer to the bus. Returns the consumer.
+        '''
+        self.consumers.append(consumer)
+        return consumer
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try :
+                if item is None:
+                    return
+                s, kwargs = item
+                self.samples.append(s)
+                for c in self.consumers:
+                    try :
+                        c(s, self.samples, **kwargs)
+                    except Exception as e:
+                        print(f'Consumer {c} failed on sample {s[0]}: {e!r}', file=sys.stderr)
+                        self.errors.append((s[0], c, e))
+            finally :
+                self._queue.task_done()
+
+    def start(self):
+        '''
+        Start the delivery thread (done automatically on the first sample).
+        '''
+        from threading import Thread
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='SampleBus', daemon=True)
+            self._thread.start()
+
+    def __call__(self, s, sl=None, **kwargs):
+        self.start()
+        self._queue.put((s, kwargs))
+        # Important! Return False to keep iteration going
+        return False
+
+    def drain(self):
+        '''
+        Wait until all queued samples are delivered.
+        '''
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        '''
+        Deliver all queued samples and stop the thread.
+        The bus may be used again afterwards.
+        '''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Cell
+def normalize_confs(spos, base):
+    '''
+    Normalize the set of configurations relative to the basic structure `base`.
+    Batched version of the `normalize_conf` function working on the
+    `(frames, nat, 3)` array of fractional (scaled) positions `spos`.
+    The same limitations apply (displacements < 1/3 of the unit cell).
+
+    Returns the arrays of the unwrapped carthesian and fractional positions.
+    '''
+    bspos = base.get_scaled_positions()
+
+    # Unwrap the displacement relative to base
+    sdx = np.asarray(spos) - bspos
+    sdx -= np.rint(sdx)
+
+    # Check if fractional displacements are below 1/3
+    assert (abs(sdx) < 1/3).all()
+
+    # Calculate unwrapped spos
+    spos = bspos + sdx
+
+    # Return carthesian positions, fractional positions
+    return spos @ np.asarray(base.get_cell()), spos
+
 # Cell
 def normalize_conf(c, base):
     '''
@@ -541,20 +2727,435 @@ def normalize_conf(c, base):
     conservation). For stronger implementation suitable for such cases look
     at dxutils package.
     '''
-    cell = base.get_cell()
-    spos = c.get_scaled_positions()
-    bspos = base.get_scaled_positions()
+    pos, spos = normalize_confs(c.get_scaled_positions()[None], base)
+    # Return carthesian positions, fractional positions
+    return pos[0], spos[0]
 
-    # Unwrap the displacement relative to base
-    sdx = spos - bspos
-    sht = (sdx < -0.5)*1 - (sdx > 0.5)*1
-    sdx += sht
+# Cell
+def write_dfset_frames(fn, xs, fs, es, start=1, configs=None, weights=None):
+    '''
+    Append a block of displacement-force data to the fn file.
+    Batched version of `write_dfset` producing the same format.
+    The sets are numbered from `start`, the `configs` sequence
+    provides the config numbers (default: the same as set numbers).
+    If the multiplicities of the sets `weights` are given the sets
+    are written in the deduplicated format (see `export_dfset`)
+    and the set numbers advance by the multiplicities.
+
+    xs, fs : `(frames, nat, 3)` arrays of displacements and forces
+    es     : `(frames,)` array of energies (eV/at)
+    '''
+    xs = np.asarray(xs)/un.Bohr
+    fs = np.asarray(fs)*un.Bohr/un.Ry
+    nat = xs.shape[1]
+    if weights is None:
+        ns, ws = range(start, start+len(xs)), [None]*len(xs)
+    else :
+        ws = [int(w) for w in weights]
+        ns = start + np.concatenate(([0], np.cumsum(ws)[:-1])).astype(int)
+    if configs is None:
+        configs = ns
+    # One format operation per frame
+    fmt = (3*'%15.7f ' + '     ' + 3*'%15.8e ' + '\n') * nat
+    data = np.concatenate((xs, fs), axis=-1).reshape(len(xs), -1)
+    recs = []
+    with open(fn, 'at') as dfset:
+        pos = dfset.tell()
+        for n, i, e, w, d in zip(ns, configs, es, ws, data):
+            blk = _dfset_header(n, i, e, w) + '\n' + fmt % tuple(d)
+            dfset.write(blk)
+            recs.append((pos, pos + len(blk), n, i, float(f'{e:8e}'), 1 if w is None else w))
+            pos += len(blk)
+    _append_dfset_index(fn, recs)
 
-    # Check if fractional displacements are below 1/3
-    assert (abs(sdx) < 1/3).all()
+# Cell
+def iter_trajectory(fn, base, chunk=1000, index=':', format=None, calc=None):
+    '''
+    Read the trajectory file `fn` in chunks of `chunk` frames.
+    Yields tuples of arrays `(spos, forces, energies)` with shapes
+    `(k, nat, 3)`, `(k, nat, 3)` and `(k,)`. If the trajectory does not
+    contain the forces (e.g. XDATCAR) the calculator `calc` is used to
+    calculate them. Missing energies are returned as NaN.
+
+    fn     : trajectory file readable by `ase.io.iread`
+    base   : basic (reference) structure of the supercell
+    chunk  : number of frames in the chunk
+    index  : ASE index string selecting frames
+    format : ASE format of the file (autodetected if None)
+    calc   : ASE calculator for the trajectories without forces
+    '''
+    import ase.io
+    from ase.calculators import calculator
+    nat = len(base)
+    frames = ase.io.iread(fn, index=index, format=format)
+    while True:
+        block = list(islice(frames, chunk))
+        if not block:
+            return
+        spos = np.empty((len(block), nat, 3))
+        forces = np.empty((len(block), nat, 3))
+        energies = np.full(len(block), np.nan)
+        for k, a in enumerate(block):
+            assert len(a) == nat
+            spos[k] = a.get_scaled_positions()
+            if a.calc is None:
+                if calc is None:
+                    raise ValueError(f'No forces in {fn} and no calculator provided.')
+                a.calc = calc
+            forces[k] = a.get_forces()
+            try :
+                energies[k] = a.get_potential_energy()
+            except (calculator.PropertyNotImplementedError, RuntimeError):
+                pass
+        yield spos, forces, energies
 
-    # Calculate unwrapped spos
-    spos = bspos + sdx
+# Cell
+def trajectory_to_dfset(fn, base, dfset, chunk=1000, index=':', format=None,
+                        Ep0=None, calc=None, start=1):
+    '''
+    Convert the trajectory in the `fn` file to the displacement-force
+    set appended to the `dfset` file. The positions are normalized
+    relative to the `base` structure in chunks of `chunk` frames.
+    The energies are written relative to `Ep0` per atom (the energy of
+    the `base` structure is used if it has a calculator attached).
+    Returns the number of written sets.
+    '''
+    nat = len(base)
+    if Ep0 is None:
+        Ep0 = base.get_potential_energy() if base.calc is not None else 0
+    bpos = base.get_positions()
+    n = start
+    for spos, forces, energies in iter_trajectory(fn, base, chunk=chunk, index=index,
+                                                  format=format, calc=calc):
+        pos, _ = normalize_confs(spos, base)
+        write_dfset_frames(dfset, pos - bpos, forces, (energies - Ep0)/nat, start=n)
+        n += len(spos)
+    return n - start
 
-    # Return carthesian positions, fractional positions
-    return dot(spos,cell), spos
\ No newline at end of file
+# Cell
+def float32_errors(x, f):
+    '''
+    Max. errors of the float32 representation of the displacements `x` (A)
+    and forces `f` (eV/A) in the units of the resolution of the DFSET file
+    written by `write_dfset`: half of the last printed digit, i.e. 0.5e-7 Bohr
+    for the displacements and 0.5e-8 of the printed mantissa for the forces.
+    Values below 1 are invisible in the DFSET file.
+    '''
+    x = np.asarray(x, dtype=float)
+    f = np.asarray(f, dtype=float)
+    ex = np.abs(x.astype(np.float32) - x).max(initial=0) / un.Bohr / 0.5e-7
+    fr = np.abs(f) * un.Bohr / un.Ry
+    ulp = 0.5e-8 * 10.0**np.floor(np.log10(np.where(fr > 0, fr, 1)))
+    ef = (np.abs(f.astype(np.float32) - f) * un.Bohr / un.Ry / ulp).max(initial=0)
+    return ex, ef
+
+# Cell
+class SampleStore:
+    '''
+    Compact store of the samples `(n, i, x, f, e)` with displacements and
+    forces kept in the arrays of the reduced precision. Behaves as the list
+    of samples (`append`, `len`, indexing, iteration) - the items are
+    returned as float64 arrays.
+
+    INPUT
+    -----
+    dtype : Type of the displacement and force arrays
+    chunk : Initial capacity of the store (doubled when full)
+    check : Max. allowed float32 error of the displacements in the units
+            of the DFSET resolution (see `float32_errors`). The `ValueError`
+            is raised if it is exceeded. None - no check.
+
+    The max. errors of the stored data are kept in the `errors` attribute.
+    '''
+    def __init__(self, dtype=np.float32, chunk=256, check=1.0):
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.check = check
+        self.errors = (0.0, 0.0)
+        self._len = 0
+        self.n = self.i = self.e = self.x = self.f = None
+
+    def _grow(self, shape):
+        cap = self.chunk if self.x is None else 2*len(self.x)
+        old = (self.n, self.i, self.e, self.x, self.f)
+        self.n, self.i = np.zeros(cap, dtype=int), np.zeros(cap, dtype=int)
+        self.e = np.zeros(cap)
+        self.x, self.f = np.zeros((cap,) + shape, self.dtype), np.zeros((cap,) + shape, self.dtype)
+        if old[0] is not None:
+            for new, o in zip((self.n, self.i, self.e, self.x, self.f), old):
+                new[:self._len] = o[:self._len]
+
+    def append(self, s):
+        n, i, x, f, e = s
+        if self.x is None or self._len == len(self.x):
+            self._grow(np.shape(x))
+        if self.dtype == np.float32:
+            ex, ef = float32_errors(x, f)
+            if self.check is not None and ex > self.check:
+                raise ValueError(f'Displacements of the sample {n} lose precision '
+                                 f'in float32 ({ex:.2f} of DFSET resolution).')
+            self.errors = (max(self.errors[0], ex), max(self.errors[1], ef))
+        k = self._len
+        self.n[k], self.i[k], self.e[k] = n, i, e
+        self.x[k], self.f[k] = x, f
+        self._len += 1
+
+    def extend(self, smpls):
+        for s in smpls:
+            self.append(s)
+
+    def __len__(self):
+        return self._len
+
+    def _item(self, k):
+        return (int(self.n[k]), int(self.i[k]), self.x[k].astype(float),
+                self.f[k].astype(float), float(self.e[k]))
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self._item(j) for j in range(*k.indices(self._len))]
+        if k < 0:
+            k += self._len
+        if not 0 <= k < self._len:
+            raise IndexError('SampleStore index out of range')
+        return self._item(k)
+
+    def __iter__(self):
+        for k in range(self._len):
+            yield self._item(k)
+
+    @property
+    def nbytes(self):
+        '''Memory used by the stored samples'''
+        k = self._len
+        return sum(a[:k].nbytes for a in (self.n, self.i, self.e, self.x, self.f)) if k else 0
+
+    def save(self, fn, compress=False):
+        '''
+        Write the store to the `fn` (`.npz`) file. With `compress`
+        the data are compressed (losslessly) with zlib.
+        '''
+        k = self._len
+        save = np.savez_compressed if compress else np.savez
+        with open(fn, 'wb') as f:
+            save(f, n=self.n[:k], i=self.i[:k], e=self.e[:k], x=self.x[:k], f=self.f[:k])
+
+    @classmethod
+    def load(cls, fn):
+        '''Read the store written by `save`'''
+        with np.load(fn) as d:
+            st = cls(dtype=d['x'].dtype, chunk=max(len(d['n']), 1))
+            st.n, st.i, st.e, st.x, st.f = (d[k] for k in ('n', 'i', 'e', 'x', 'f'))
+        st._len = len(st.n)
+        return st
+
+    def write_dfset(self, fn):
+        '''Append the stored samples to the DFSET file `fn` (see `write_dfset`)'''
+        k = self._len
+        if k and (np.diff(self.n[:k]) == 1).all():
+            write_dfset_frames(fn, self.x[:k].astype(float), self.f[:k].astype(float),
+                               self.e[:k], start=self.n[0], configs=self.i[:k])
+        else :
+            for s in self:
+                write_dfset(fn, s)
+
+# Cell
+def read_vasprun_ef(fn):
+    '''
+    Extract the final energy (sigma->0, as reported by ASE),
+    fractional positions and forces (in VASP atom order)
+    from the vasprun.xml file with the streaming XML parser.
+    Returns `(energy, spos, forces)` tuple or None if the file
+    does not contain a complete calculation.
+    '''
+    from xml.etree.ElementTree import iterparse, ParseError
+
+    def varray(el):
+        return np.array([[float(v) for v in r.text.split()] for r in el.findall('v')])
+
+    res = None
+    de = 0
+    try :
+        for event, elem in iterparse(fn, events=('end',)):
+            if elem.tag in ('eigenvalues', 'dos', 'projected', 'dielectricfunction'):
+                elem.clear()
+            elif elem.tag == 'scstep':
+                # Workaround for the VASP bug in calculation/energy/e_0_energy
+                e0 = elem.find('energy/i[@name="e_0_energy"]')
+                efr = elem.find('energy/i[@name="e_fr_energy"]')
+                if e0 is not None and efr is not None:
+                    de = float(e0.text) - float(efr.text)
+                elem.clear()
+            elif elem.tag == 'calculation':
+                efr = elem.find('energy/i[@name="e_fr_energy"]')
+                spos = elem.find('structure/varray[@name="positions"]')
+                forces = elem.find('varray[@name="forces"]')
+                if None not in (efr, spos, forces):
+                    res = (float(efr.text) + de, varray(spos), varray(forces))
+                elem.clear()
+    except ParseError:
+        # Incomplete file - calculation not finished
+        return None
+    return res
+
+# Cell
+def _read_calc_dir(d):
+    '''
+    Read the results from the calculation directory `d` in ASE atom order.
+    '''
+    res = read_vasprun_ef(f'{d}/vasprun.xml')
+    if res is None:
+        return None
+    e, spos, forces = res
+    if os.path.exists(f'{d}/ase-sort.dat'):
+        resort = np.loadtxt(f'{d}/ase-sort.dat', dtype=int, ndmin=2)[:,1]
+        spos, forces = spos[resort], forces[resort]
+    return e, spos, forces
+
+# Cell
+def read_dfset_sequence(fn):
+    '''
+    Read the (set, config) sequence from the headers of the DFSET file.
+    The sets with multiplicities are expanded into the repeated sets.
+    Returns None if the file does not exist.
+    '''
+    try :
+        with open(fn) as dfset:
+            hdrs = [_dfset_header_fields(l) for l in dfset if 'set:' in l]
+    except FileNotFoundError:
+        return None
+    return [(n + k, c) for n, c, e, w in hdrs for k in range(w)]
+
+# Cell
+def rebuild_dfset(directory, base, dfset='DFSET', Ep0=None, sequence=None,
+                  nproc=None, cache=True, dedup=False):
+    '''
+    Rebuild the DFSET file from the VASP calculations in the
+    `smpl/NNNN` subdirectories of the run `directory`.
+
+    INPUT
+    -----
+    directory : Run directory (the `directory` of the `HECSS_Sampler`)
+    base      : Basic (reference) structure of the supercell
+    dfset     : Name of the DFSET file in the run directory (overwritten)
+    Ep0       : Energy of the base structure. If None the energy of the
+                `base` is used if it has calculator attached (0 otherwise).
+    sequence  : List of (set, config) pairs defining the order of the sets.
+                If None the sequence is read from the existing DFSET file
+                or, if it does not exist, every calculated config is used once.
+    nproc     : Number of parallel reader processes (default: number of CPUs)
+    cache     : Use the cache of extracted data (`.{dfset}.cache.npz` file),
+                only new or modified calculations are parsed.
+    dedup     : Write the consecutive repetitions of the config as
+                a single set with the multiplicity (see `export_dfset`).
+
+    OUTPUT
+    ------
+    Number of samples written to the DFSET file
+    (the repetitions of the configs included).
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    wd = Path(directory)
+    nat = len(base)
+    if Ep0 is None:
+        Ep0 = base.get_potential_energy() if base.calc is not None else 0
+
+    dirs = {int(d.name): d for d in sorted(wd.glob('smpl/[0-9]*'))
+            if d.name.isdigit() and (d / 'vasprun.xml').exists()}
+    stamps = {c: (d / 'vasprun.xml').stat() for c, d in dirs.items()}
+    stamps = {c: (s.st_mtime_ns, s.st_size) for c, s in stamps.items()}
+
+    # Results extracted on the previous rebuild
+    data = {}
+    cfn = wd / f'.{dfset}.cache.npz'
+    if cache and cfn.exists():
+        with np.load(cfn) as cd:
+            for c, st, e, sp, fr in zip(cd['configs'], cd['stamps'], cd['e'], cd['spos'], cd['forces']):
+                if stamps.get(int(c)) == tuple(st):
+                    data[int(c)] = (e, sp, fr)
+
+    todo = [c for c in dirs if c not in data]
+    if todo:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            for c, res in zip(todo, pool.map(_read_calc_dir, [str(dirs[c]) for c in todo])):
+                if res is not None:
+                    data[c] = res
+
+    if cache and data:
+        cl = sorted(data)
+        np.savez(cfn, configs=cl, stamps=[stamps[c] for c in cl],
+                 e=[data[c][0] for c in cl],
+                 spos=[data[c][1] for c in cl], forces=[data[c][2] for c in cl])
+
+    if sequence is None:
+        sequence = read_dfset_sequence(wd / dfset)
+    if sequence is None:
+        sequence = [(n+1, c) for n, c in enumerate(sorted(data))]
+    missing = sorted({c for n, c in sequence if c not in data})
+    if missing:
+        raise ValueError(f'Missing calculations for configs: {missing}')
+
+    configs = [c for n, c in sequence]
+    weights = None
+    if dedup:
+        runs = np.flatnonzero(np.diff(configs, prepend=np.nan))
+        weights = np.diff(runs, append=len(configs))
+        configs = [configs[k] for k in runs]
+    pos, _ = normalize_confs(np.array([data[c][1] for c in configs]), base)
+    tmp = wd / f'.{dfset}.tmp'
+    if tmp.exists():
+        tmp.unlink()
+    write_dfset_frames(tmp, pos - base.get_positions(),
+                       np.array([data[c][2] for c in configs]),
+                       (np.array([data[c][0] for c in configs]) - Ep0)/nat,
+                       start=sequence[0][0], configs=configs, weights=weights)
+    os.replace(tmp, wd / dfset)
+    if _dfset_index_path(tmp).exists():
+        os.replace(_dfset_index_path(tmp), _dfset_index_path(wd / dfset))
+    return len(sequence)
+
+# Cell
+def symmetry_operations(cryst, symprec=1e-5, unique_rotations=True, ctx=None):
+    '''
+    Symmetry operations of the structure `cryst` in the form suitable
+    for transforming the displacement and force arrays.
+
+    INPUT
+    -----
+    cryst            : ASE structure
+    symprec          : symmetry detection treshold for spglib functions
+    unique_rotations : Use only one operation (the first found)
+                       for every distinct rotation.
+    ctx              : `StructureContext` of the structure (created if None)
+
+    OUTPUT
+    ------
+    Tuple of the `(nops, 3, 3)` array of carthesian rotation matrices and
+    the `(nops, nat)` array of atom permutations. The atom `j` is mapped
+    onto the atom `perm[k, j]` by the operation `k`.
+    '''
+    if ctx is None:
+        ctx = get_structure_context(cryst, symprec)
+    return ctx.operations(unique_rotations)
+
+# Cell
+def augment_sample(s, ops, identity=False):
+    '''
+    Apply the symmetry operations `ops` (from `symmetry_operations`)
+    to the sample `s` = (n, i, x, f, e). Returns the `(nimg, nat, 3)`
+    arrays of displacements and forces of the symmetry images.
+    The identity operation is skipped unless `identity` is True.
+    '''
+    crot, perm = ops
+    n, i, x, f, e = s
+    if not identity:
+        keep = ~np.array([np.allclose(r, np.eye(3)) and (p == np.arange(len(p))).all()
+                          for r, p in zip(crot, perm)])
+        crot, perm = crot[keep], perm[keep]
+    k = np.arange(len(crot))[:, None]
+    xs = np.empty((len(crot),) + x.shape)
+    fs = np.empty((len(crot),) + f.shape)
+    xs[k, perm] = np.einsum('kab,nb->kna', crot, x)
+    fs[k, perm] = np.einsum('kab,nb->kna', crot, f)
+    return xs, fs
\ No newline at end of file
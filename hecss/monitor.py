@@ -1,24 +1,28 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 12_monitor.ipynb (unless otherwise specified).
 
-__all__ = ['THz', 'plot_band_set', 'plot_bands', 'plot_bands_file', 'run_alamode', 'get_dfset_len', 'show_dc_conv',
-           'build_bnd_lst', 'build_omega', 'plot_omega', 'monitor_phonons', 'load_dfset', 'plot_stats', 'monitor_stats',
-           'moving_average', 'ewma', 'plot_hist', 'plot_virial_stat', 'plot_acceptance_history', 'plot_dofmu_stat',
+__all__ = ['THz', 'plot_band_set', 'plot_bands', 'load_bands', 'plot_bands_file', 'run_alamode', 'get_dfset_len',
+           'show_dc_conv', 'build_bnd_lst', 'build_omega', 'plot_omega', 'monitor_phonons', 'load_dfset', 'plot_stats',
+           'plot_energy_stats', 'monitor_stats', 'DFSETStats', 'RunMonitor', 'monitor_daemon', 'moving_average', 'ewma',
+           'plot_hist', 'plot_acc_hist', 'plot_virial_stat', 'plot_acceptance_history', 'chain_ess', 'print_ess_report',
+           'plot_autocorr', 'load_bands_many', 'compare_bands', 'print_bands_comparison', 'plot_dofmu_stat',
            'plot_xs_stat']
 
 # Cell
 from numpy import sqrt, loadtxt, array, linspace, histogram
-from numpy import median, abs, convolve, ones, arange, cumsum
-from IPython.display import clear_output
+from numpy import median, abs, convolve, ones, zeros, arange, cumsum
+from numpy import stack, interp, searchsorted, where, allclose
 import subprocess
-from time import sleep
+from time import sleep, monotonic
+import os
+import json
+from pathlib import Path
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import plot, figure, subplot, legend, show, sca, title
 from matplotlib.pyplot import hist, semilogx, semilogy, axvspan, axhspan
 from matplotlib.pyplot import xlabel, ylabel, xticks, xlim, ylim, axhline, axvline
-from scipy import stats
 import sys
-from spglib import find_primitive, get_symmetry_dataset
-from collections import Counter
+from .core import autocorrelation, autocorr_time, effective_sample_size
+from .core import get_structure_context, DFSETIndex, VirialAccumulator, History
 
 # Cell
 from ase.data import chemical_symbols
@@ -50,13 +54,21 @@ def plot_bands(bnd, kpnts, units=THz, decorate=True, lbl=None, **kwargs):
         ylabel('Frequency (THz)')
 
 # Cell
-def plot_bands_file(fn, units=THz, decorate=True, lbl=None, **kwargs):
-    bnd = loadtxt(fn).T
-
+def load_bands(fn):
+    '''
+    Read the ALAMODE `.bands` file. Returns the array of bands
+    (k-axis in the first row) and the (labels, positions) tuple
+    of the high-symmetry points. The file is read in one pass.
+    '''
     with open(fn) as f:
         p_lbl = [l if l!='G' else '$\\Gamma$' for l in f.readline().split()[1:]]
         p_pnt = [float(v) for v in f.readline().split()[1:]]
-    kpnts = (p_lbl, p_pnt)
+        bnd = loadtxt(f, ndmin=2).T
+    return bnd, (p_lbl, p_pnt)
+
+# Cell
+def plot_bands_file(fn, units=THz, decorate=True, lbl=None, **kwargs):
+    bnd, kpnts = load_bands(fn)
 
     if lbl is None:
         lbl=fn
@@ -97,9 +109,12 @@ def run_alamode(d='phon', prefix='cryst', kpath='cryst', dfset='DFSET', sc='../s
 
 # Cell
 def get_dfset_len(fn='phon/DFSET'):
+    '''
+    Number of complete sets in the DFSET file (0 if it does not exist).
+    Uses the index of the file (see `DFSETIndex`).
+    '''
     try :
-        with open(fn) as dfset:
-            return len([l for l in dfset if 'set:' in l])
+        return len(DFSETIndex(fn))
     except FileNotFoundError:
             return 0
 
@@ -132,7 +147,7 @@ def build_bnd_lst(directory='phon', dfset='DFSET', prefix='cryst', kpath='crast'
             print(f'Using first {n:3} samples', end='\n')
         run_alamode(d=directory, prefix=prefix, dfset=dfset, kpath=kpath, sc=sc,
                     o=order, n=n, c2=cutoff, born=born, charge=charge)
-        bl[n]=loadtxt(f'{directory}/{prefix}.bands').T
+        bl[n]=load_bands(f'{directory}/{prefix}.bands')[0]
     if verbose :
         print()
     return bl
@@ -170,6 +185,7 @@ def plot_omega(omega):
 def monitor_phonons(directory='phon', dfset='DFSET', prefix='cryst', kpath='cryst', sc='../sc/CONTCAR',
                     order=1, cutoff=10, born=None, charge=None, k_list=None,
                     fig_out=None, once=False):
+    from IPython.display import clear_output
 
     def update_fig(fig, bnd_lst, kpnts, k_lst):
         if fig is not None:
@@ -207,14 +223,9 @@ def monitor_phonons(directory='phon', dfset='DFSET', prefix='cryst', kpath='crys
     N = get_dfset_len(f'{directory}/{dfset}')
     run_alamode(d=directory, dfset=dfset, prefix=prefix, kpath=kpath, sc=sc,
                 o=order, n=N, c2=cutoff, born=born, charge=charge)
-    bnd_lst[N] = loadtxt(f'{directory}/{prefix}.bands').T
+    bnd_lst[N], kpnts = load_bands(f'{directory}/{prefix}.bands')
     prev_N = N
 
-    with open(f'{directory}/{prefix}.bands') as f:
-        p_lbl = [v if v!='G' else '$\\Gamma$' for v in f.readline().split()[1:]]
-        p_pnt = [float(v) for v in f.readline().split()[1:]]
-    kpnts = (p_lbl, p_pnt)
-
     fig = update_fig(None, bnd_lst, kpnts, k_list)
     if fig_out is not None :
         fig_out.append(fig)
@@ -225,7 +236,7 @@ def monitor_phonons(directory='phon', dfset='DFSET', prefix='cryst', kpath='crys
             r = run_alamode(d=directory, dfset=dfset, prefix=prefix, kpath=kpath, sc=sc,
                             o=order, n=N, c2=cutoff, born=born, charge=charge)
             if r[0]:
-                bnd_lst[N] = loadtxt(f'{directory}/{prefix}.bands').T
+                bnd_lst[N] = load_bands(f'{directory}/{prefix}.bands')[0]
                 fig = update_fig(fig, bnd_lst, kpnts, k_list)
                 if fig_out is not None :
                     fig_out[-1]=fig
@@ -240,7 +251,7 @@ def monitor_phonons(directory='phon', dfset='DFSET', prefix='cryst', kpath='crys
                         r = run_alamode(d=directory, dfset=dfset, prefix=prefix, kpath=kpath, sc=sc,
                                         o=order, n=NN, c2=cutoff, born=born, charge=charge)
                         if r[0]:
-                            bnd_lst[NN] = loadtxt(f'{directory}/{prefix}.bands').T
+                            bnd_lst[NN] = load_bands(f'{directory}/{prefix}.bands')[0]
                             fig = update_fig(fig, bnd_lst, kpnts, k_list)
                             if fig_out is not None :
                                 fig_out[-1]=fig
@@ -255,30 +266,16 @@ def monitor_phonons(directory='phon', dfset='DFSET', prefix='cryst', kpath='crys
                 sleep(30)
 
 # Cell
-def load_dfset(base_dir='phon', dfsetfn='DFSET'):
+def load_dfset(base_dir='phon', dfsetfn='DFSET', emin=None, emax=None, expand=True):
     '''
-    Load contents of the DFSET flie and return dfset array
+    Load contents of the DFSET flie and return the list of configurations.
+    Only the sets with energies (eV/at) in the [emin, emax] window
+    are loaded if the limits are given. The sets of the deduplicated
+    file are repeated according to their multiplicities unless
+    `expand` is False.
     '''
-    N = get_dfset_len(f'{base_dir}/{dfsetfn}')
-    dfset = loadtxt(f'{base_dir}/{dfsetfn}').reshape(N,-1,6)
-    nat=dfset.shape[1]
-
-    confs = []
-    sets = []
-    es = []
-    with open(f'{base_dir}/{dfsetfn}') as dff:
-        for l in dff:
-            if 'set:' not in l:
-                continue
-            s, _, c, _, e = l.split()[2:7]
-            s = int(s)
-            c = int(c)
-            e = float(e)
-            confs.append((s,c,
-                          dfset[s-1,:,0:3]*un.Bohr,
-                          dfset[s-1,:,3:]*un.Ry/un.Bohr, e))
-
-    return confs
+    dfi = DFSETIndex(f'{base_dir}/{dfsetfn}')
+    return dfi.read(dfi.select(emin, emax), expand=expand)
 
 # Cell
 def plot_stats(confs, T=None, sqrN=False, show=True, plotchi2=False):
@@ -299,12 +296,26 @@ def plot_stats(confs, T=None, sqrN=False, show=True, plotchi2=False):
     #          for d in sorted(glob(base_dir+'/../calc/T_600.0K/smpl/0*/'))]
 
     es = array([_[-1] for _ in confs])
+    nat = confs[0][-3].shape[0]
+
+    plot_energy_stats(es, nat, T=T, sqrN=sqrN, show=show, plotchi2=plotchi2)
+
+def plot_energy_stats(es, nat, T=None, sqrN=False, show=True, plotchi2=False):
+    '''
+    Plot the energy histogram of the samples against the target distribution.
+    Works directly on the array of sample energies `es` (eV/at) of the
+    `nat`-atom supercell, thus it does not need the full configurations.
+
+    es    - array of sample energies
+    nat   - number of atoms in the supercell
+    T     - target temperature in Kelvin
+    show  - call show() fuction at the end (default:True)
+    '''
+    from scipy import stats
 
     if T is None:
         T = 2*es.mean()/3/un.kB
 
-    nat = confs[0][-3].shape[0]
-
     E_goal = 3*T*un.kB/2
     Es = sqrt(3/2)*un.kB*T/sqrt(nat)
     e = linspace(E_goal - 3*Es, E_goal + 3*Es, 200)
@@ -342,6 +353,7 @@ def plot_stats(confs, T=None, sqrN=False, show=True, plotchi2=False):
 
 # Cell
 def monitor_stats(T=300, directory='phon', dfset='DFSET', plotchi2=False, sqrN=False, once=False):
+    from IPython.display import clear_output
 
     prev_N = get_dfset_len(f'{directory}/{dfset}')-1
 
@@ -369,6 +381,249 @@ def monitor_stats(T=300, directory='phon', dfset='DFSET', plotchi2=False, sqrN=F
         else :
             sleep(15)
 
+# Cell
+class DFSETStats:
+    '''
+    Incremental statistics of the samples stored in the DFSET file `fn`.
+    Every call to `update` reads only the part of the file appended since
+    the previous call. The energy moments are kept as running power sums,
+    the energies of the samples are kept for plotting the histogram.
+    The multiplicities of the sets in the deduplicated file are followed
+    by re-reading the header of the last set. The file replaced (other inode)
+    or rewritten in place (changed last line read before) is read from scratch.
+    '''
+    def __init__(self, fn, T=None):
+        self.fn = fn
+        self.T = T
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.nat = 0
+        self.es = []
+        self.shift = None
+        self.sums = zeros(5)
+        self.accepted = 0
+        self.configs = set()
+        self.last_config = None
+        self.nsets = 0
+        self.last_hdr = None
+        self.ino = None
+        self.tail = None
+
+    def update(self):
+        '''
+        Read the sets appended to the file since the last call.
+        Returns the number of new samples.
+        '''
+        try :
+            st = os.stat(self.fn)
+        except FileNotFoundError:
+            return 0
+        size = st.st_size
+        if size < self.offset or (self.ino is not None and self.ino != (st.st_dev, st.st_ino)):
+            # The file was truncated or re-created. Start from scratch.
+            self.reset()
+        self.ino = (st.st_dev, st.st_ino)
+        new = []
+        with open(self.fn, 'rb') as dfset:
+            if self.tail is not None:
+                # The file rewritten in place (e.g. with the same size)
+                # does not end the part read before with the same line
+                off, l = self.tail
+                dfset.seek(off)
+                if dfset.read(len(l)) != l:
+                    self.reset()
+                    self.ino = (st.st_dev, st.st_ino)
+            if size == self.offset and self.last_hdr is None:
+                return 0
+            if self.last_hdr is not None:
+                # Repetitions of the last set counted in place
+                off, e, w = self.last_hdr
+                dfset.seek(off)
+                t = dfset.readline().split()
+                nw = int(t[9]) if len(t) > 9 and t[8] == b'weight:' else 1
+                new += [e]*(nw - w)
+                self.last_hdr = (off, e, max(w, nw))
+            dfset.seek(self.offset)
+            chunk = dfset.read(size - self.offset)
+        # Use only complete lines. The rest will be read next time.
+        end = chunk.rfind(b'\n') + 1
+        pos = self.offset
+        self.offset += end
+        for l in chunk[:end].splitlines(keepends=True):
+            if b'set:' in l:
+                t = l.split()
+                c, e = int(t[4]), float(t[6])
+                w = int(t[9]) if len(t) > 9 and t[8] == b'weight:' else 1
+                if self.last_config is not None and c != self.last_config:
+                    self.accepted += 1
+                self.last_config = c
+                self.configs.add(c)
+                self.nsets += 1
+                # Only the deduplicated sets may grow
+                self.last_hdr = (pos, e, w) if len(t) > 9 else None
+                new += [e]*w
+            else :
+                # The headers of the deduplicated file change in place
+                self.tail = (pos, l)
+                if l.strip() and self.nsets == 1:
+                    # Count atoms in the first set
+                    self.nat += 1
+            pos += len(l)
+        self.es += new
+        if new:
+            if self.shift is None:
+                self.shift = new[0]
+            de = array(new) - self.shift
+            self.sums += array([(de**k).sum() for k in range(5)])
+        return len(new)
+
+    def summary(self):
+        '''
+        Return dictionary with the current statistics of the run.
+        '''
+        n = len(self.es)
+        smr = {'dfset': str(self.fn), 'samples': n,
+               'configs': len(self.configs), 'nat': self.nat}
+        if n == 0:
+            return smr
+        s1, s2, s3, s4 = self.sums[1:]/n
+        mu2 = max(s2 - s1**2, 0)
+        mu3 = s3 - 3*s1*s2 + 2*s1**3
+        mu4 = s4 - 4*s1*s3 + 6*s1**2*s2 - 3*s1**4
+        mean = self.shift + s1
+        T = self.T if self.T is not None else 2*mean/3/un.kB
+        E_goal = 3*T*un.kB/2
+        smr.update(T=T, E_goal=E_goal, mean=mean, std=sqrt(mu2),
+                   skewness=mu3/mu2**1.5 if mu2 > 0 else 0.0,
+                   kurtosis=mu4/mu2**2 - 3 if mu2 > 0 else 0.0,
+                   acceptance=self.accepted/(n-1) if n > 1 else 1.0)
+        if self.nat > 0:
+            Es = sqrt(3/2)*un.kB*T/sqrt(self.nat)
+            smr.update(Es=Es, dE=(mean - E_goal)/Es, std_ratio=sqrt(mu2)/Es)
+        return smr
+
+# Cell
+class RunMonitor:
+    '''
+    Monitor of a single run directory used by the `monitor_daemon`.
+    Tracks the DFSET statistics and (optionally) the changes of the
+    phonon frequencies in the `bands` file (relative to the directory)
+    and writes rate-limited JSON/PNG snapshots of the state.
+    '''
+    def __init__(self, directory, T=None, dfset='DFSET', bands=None, outdir=None, prefix='monitor'):
+        self.directory = Path(directory)
+        self.stats = DFSETStats(self.directory / dfset, T=T)
+        self.bands = None if bands is None else self.directory / bands
+        if outdir is None:
+            self.out = self.directory / prefix
+        else :
+            name = str(self.directory).strip('/').replace('/', '_')
+            self.out = Path(outdir) / f'{name}_{prefix}'
+        self.bnd = None
+        self.bnd_mtime = None
+        self.freq = []
+        self.changed = {'json': False, 'png': False}
+        self.written = {'json': None, 'png': None}
+
+    def update(self):
+        if self.stats.update() > 0:
+            self.changed = {k: True for k in self.changed}
+        if self.bands is not None and self.bands.exists():
+            mtime = self.bands.stat().st_mtime
+            if mtime != self.bnd_mtime:
+                try :
+                    bnd, self.kpnts = load_bands(self.bands)
+                except ValueError:
+                    # File is still being written
+                    return
+                self.bnd_mtime = mtime
+                if self.bnd is not None and bnd.shape == self.bnd.shape:
+                    dw = un.invcm * abs(bnd[1:] - self.bnd[1:]) / THz
+                    self.freq.append({'samples': len(self.stats.es),
+                                      'max': dw.max(), 'rms': sqrt((dw**2).mean())})
+                self.bnd = bnd
+                self.changed = {k: True for k in self.changed}
+
+    def summary(self):
+        smr = self.stats.summary()
+        smr['directory'] = str(self.directory)
+        if self.freq:
+            smr['freq_convergence'] = self.freq
+        return smr
+
+    def write_json(self):
+        fn = self.out.with_suffix('.json')
+        with open(f'{fn}.tmp', 'wt') as jf:
+            json.dump(self.summary(), jf, indent=1)
+        os.replace(f'{fn}.tmp', fn)
+
+    def write_png(self):
+        es = array(self.stats.es)
+        if len(es) < 3:
+            return
+        fn = self.out.with_suffix('.png')
+        ncol = 1 if self.bnd is None else 2
+        fig = figure(figsize=(7*ncol, 4))
+        fig.add_subplot(1, ncol, 1)
+        plot_energy_stats(es, max(self.stats.nat, 1), T=self.stats.T, sqrN=True, show=False)
+        if self.bnd is not None:
+            fig.add_subplot(1, ncol, 2)
+            plot_bands(self.bnd, self.kpnts, lbl=f'{len(es)}')
+        fig.savefig(f'{fn}.tmp.png')
+        plt.close(fig)
+        os.replace(f'{fn}.tmp.png', fn)
+
+    def snapshot(self, json_every=30, png_every=300, force=False):
+        '''
+        Write the snapshots which are out of date but not more often
+        than every `json_every`/`png_every` seconds (unless `force`d).
+        '''
+        now = monotonic()
+        for kind, every, write in (('json', json_every, self.write_json),
+                                   ('png', png_every, self.write_png)):
+            last = self.written[kind]
+            if self.changed[kind] and (force or last is None or now - last >= every):
+                write()
+                self.written[kind] = now
+                self.changed[kind] = False
+
+# Cell
+def monitor_daemon(dirs, T=None, dfset='DFSET', bands=None, outdir=None,
+                   interval=15, json_every=30, png_every=300, once=False, verbose=False):
+    '''
+    Watch the run directories `dirs` and write the JSON summaries and
+    PNG plots of the statistics of the runs. Does not require IPython
+    or a display, suitable for running on compute nodes.
+
+    dirs       - list of run directories
+    T          - target temperature in Kelvin (estimated from the samples if None)
+    dfset      - name of the DFSET file in the run directory
+    bands      - name of the ALAMODE bands file (relative to the run directory)
+                 to track the convergence of the frequencies
+    outdir     - directory for the snapshots (default: the run directory)
+    interval   - time between the checks of the run directories (s)
+    json_every - minimal time between the JSON snapshots (s)
+    png_every  - minimal time between the PNG snapshots (s)
+    once       - update all snapshots once and exit
+    '''
+    mons = [RunMonitor(d, T=T, dfset=dfset, bands=bands, outdir=outdir) for d in dirs]
+    while True:
+        for m in mons:
+            m.update()
+            m.snapshot(json_every=json_every, png_every=png_every, force=once)
+            if verbose:
+                smr = m.stats.summary()
+                print(f'{m.directory}: {smr["samples"]} samples', end='')
+                if smr['samples'] > 0:
+                    print(f'  <E>: {smr["mean"]:.5f}  acc.: {100*smr["acceptance"]:5.1f}%', end='')
+                print()
+                sys.stdout.flush()
+        if once:
+            break
+        sleep(interval)
+
 # Cell
 
 def moving_average(x, w):
@@ -395,6 +650,7 @@ def ewma(data, window):
 # Cell
 
 def plot_hist(v, el, n, l='', alpha=0.2, normal=True, df=3):
+    from scipy import stats
     if normal:
         rfun = stats.norm
     else:
@@ -420,15 +676,73 @@ def plot_hist(v, el, n, l='', alpha=0.2, normal=True, df=3):
 
 # Cell
 
-def plot_virial_stat(cryst, smpl, T):
-    elems = cryst.get_chemical_symbols()
-    vir = array([abs(s[2]*s[3]) for s in smpl])/(un.kB*T)
-    nat = len(elems)
-    m, s = plot_hist(vir.mean(axis=(-1,-2)), 'Total', 0, normal=True)
-    for n, el in enumerate(set(elems)):
-        elmask = array(elems)==el
-        plot_hist(vir[:, elmask, :].mean(axis=(-1,-2)),
-                  el, n+1, normal=False, df=3*sum(elmask))
+def _plot_dofmu_acc(ctx, acc):
+    figure(figsize=(10,4))
+    t, h = acc.history()
+    semilogy()
+    for i, el in enumerate(ctx.elements):
+        plot(t, h[:, i+1], label=f'{chemical_symbols[el]} (block={acc.block})', color=f'C{i}')
+    axvspan(0, acc.skip, color='k', alpha=0.2)
+    title('Virial history')
+    xlabel('Steps')
+    ylabel('Virial/Temperature V$_{DOF}$/T')
+    legend();
+    show();
+
+    mi, ma = -1, -1
+    for i, el in enumerate(ctx.elements):
+        m, s = plot_acc_hist(acc, i+1, chemical_symbols[el], i)
+        if mi < 0 or mi > m-3*s:
+            mi = m-3*s
+        if ma < 0 or ma < m+4*s:
+            ma = m+4*s
+    legend();
+    xlim(mi, ma)
+    title('Virial distribution')
+    ylabel('Probability density')
+    xlabel('Virial/Temperature')
+    show() ;
+
+# Cell
+
+def plot_acc_hist(acc, g, el, n, l='', alpha=0.2):
+    '''
+    Plot the histogram of the group `g` of the `VirialAccumulator` `acc`
+    with the normal distribution of the same mean and variance.
+    The counterpart of `plot_hist` for the streaming statistics.
+    '''
+    from scipy import stats
+    # Join the bins to get about sqrt(n) bins in the occupied range
+    occ = acc.counts[g].nonzero()[0]
+    merge = max(1, int((occ[-1] - occ[0] + 1) / sqrt(max(acc.n, 1)))) if len(occ) else 1
+    d, edges = acc.hist(g, merge)
+    plt.stairs(d, edges, label=f'{el}{l}', fill=True, alpha=alpha, color=f'C{n}')
+    m, s = acc.el_mean[g], acc.el_std[g]
+    axvline(m, ls='--', color=f'C{n}', label=f'{el}{l} = {m:.2f}+/-{s:.2f}')
+    x = linspace(m-3*s, m+3*s, 100)
+    plot(x, stats.norm.pdf(x, m, s), ls='-', lw=1, color=f'C{n}', alpha=alpha+0.1)
+    xlim(m-3*s, m+3*s)
+    return m, s
+
+# Cell
+
+def plot_virial_stat(cryst, smpl, T, ctx=None):
+    '''
+    Plot the distribution of the virials in the sample `smpl` at temperature `T`.
+    The `smpl` may be the list of samples or the `VirialAccumulator`
+    filled by the sampler (`virial_acc` parameter).
+    '''
+    if ctx is None:
+        ctx = get_structure_context(cryst)
+    if isinstance(smpl, VirialAccumulator):
+        m, s = plot_acc_hist(smpl, 0, 'Total', 0)
+        for n, el in enumerate(ctx.elements):
+            plot_acc_hist(smpl, n+1, chemical_symbols[el], n+1)
+    else :
+        vir = array([abs(s[2]*s[3]) for s in smpl])/(un.kB*T)
+        m, s = plot_hist(vir.mean(axis=(-1,-2)), 'Total', 0, normal=True)
+        for n, (el, v) in enumerate(zip(ctx.elements, ctx.el_mean(vir).T)):
+            plot_hist(v, chemical_symbols[el], n+1, normal=False, df=3*len(ctx.elidx[el]))
     axvline(T/T, ls=':', color='C5', label=f'{T:.0f} K')
     xlim(m - 5*s, m + 7*s)
     legend()
@@ -447,33 +761,186 @@ def plot_acceptance_history(smpl):
     ylabel('Acceptance ratio (approx., %)');
 
 # Cell
+def chain_ess(smpl, T=None, xsl=None, c=5):
+    '''
+    Autocorrelation analysis of the sample chain `smpl`.
+    Returns dictionary of (tau, ess) tuples for the energies (scalars),
+    the per-DOF virials (arrays of the `(nat, 3)` shape) and, if the
+    amplitude correction history `xsl` is given, the xscale history.
+
+    smpl - list of samples (as returned by the sampler or `load_dfset`)
+    T    - target temperature in Kelvin (estimated from the energies if None)
+    xsl  - list or `(steps, nat, 3)` array of amplitude corrections
+    c    - window parameter of the autocorrelation time estimator
+    '''
+    es = array([s[-1] for s in smpl])
+    if T is None:
+        T = 2*es.mean()/3/un.kB
+    res = {'energy': es}
+    res['virial'] = abs(array([s[2]*s[3] for s in smpl]))/(un.kB*T)
+    if xsl is not None and len(xsl) > 0:
+        res['xscale'] = array(xsl)
+    return {k: (autocorr_time(v, c), effective_sample_size(v, c)) for k, v in res.items()}
 
-def plot_dofmu_stat(cryst, dofmu, skip=10, window=10):
-    symm = get_symmetry_dataset(cryst)
-    dofmap = symm['mapping_to_primitive']
-    dof = set(dofmap)
-    dofmul = Counter(symm['mapping_to_primitive'])
-    elems = dict(zip(symm['std_mapping_to_primitive'],symm['std_types']))
-    elmap = array(sorted(elems.items())).T
+# Cell
+def print_ess_report(res, cryst=None, file=None):
+    '''
+    Print the table with the results of the `chain_ess` function.
+    For the array quantities the min/median/max values over the DOFs
+    are printed, per element if the structure `cryst` is given.
+    '''
+    print(f'{"Quantity":16} {"tau":>8} {"ESS":>8} {"ESS min":>8} {"ESS med":>8} {"ESS max":>8}', file=file)
+    for k, (tau, ess) in res.items():
+        if ess.ndim == 0:
+            print(f'{k:16} {tau:8.2f} {ess:8.1f}', file=file)
+            continue
+        groups = [('', ones(ess.shape[0], dtype=bool))]
+        if cryst is not None:
+            elems = array(cryst.get_chemical_symbols())
+            groups += [(f' {el}', elems==el) for el in sorted(set(elems))]
+        for el, elmask in groups:
+            e = ess[elmask].ravel()
+            print(f'{k+el:16} {median(tau[elmask]):8.2f} {"":8} '
+                  f'{e.min():8.1f} {median(e):8.1f} {e.max():8.1f}', file=file)
+
+# Cell
+def plot_autocorr(x, maxlag=50, lbl=None, **kwargs):
+    '''
+    Plot the autocorrelation function of the sequence `x`.
+    For multidimensional `x` the mean over the components is plotted.
+    '''
+    acf = autocorrelation(x)
+    if acf.ndim > 1:
+        acf = acf.reshape(len(acf), -1).mean(axis=-1)
+    maxlag = min(maxlag, len(acf))
+    plot(arange(maxlag), acf[:maxlag], label=lbl, **kwargs)
+    axhline(0, ls=':', lw=1, alpha=0.5)
+    xlabel('Lag (steps)')
+    ylabel('Autocorrelation')
+
+# Cell
+def load_bands_many(files, nproc=None):
+    '''
+    Read many `.bands` files in parallel with `nproc` processes
+    (default: number of CPUs). Returns the list of `load_bands` results.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = [str(f) for f in files]
+    if nproc == 1 or len(files) < 2:
+        return [load_bands(f) for f in files]
+    chunk = max(1, len(files) // (4 * (nproc or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        return list(pool.map(load_bands, files, chunksize=chunk))
+
+# Cell
+def _align_bands(bnd, kpnts, ref):
+    '''
+    Interpolate the bands `bnd` with the high-symmetry points `kpnts`
+    onto the k-axis of the reference `ref` = (bands, kpnts).
+    Returns the `(branches, k-points)` array without the k-axis.
+    '''
+    rbnd, (rlbl, rpnt) = ref
+    lbl, pnt = kpnts
+    if list(lbl) != list(rlbl):
+        raise ValueError(f'Different k-paths: {lbl} vs. {rlbl}')
+    if len(bnd) != len(rbnd):
+        raise ValueError(f'Different number of branches: {len(bnd)-1} vs. {len(rbnd)-1}')
+    # Map every segment of the path onto the reference segment
+    k = interp(bnd[0], pnt, rpnt)
+    rk = rbnd[0]
+    if k.shape == rk.shape and allclose(k, rk):
+        return bnd[1:]
+    i = searchsorted(k, rk).clip(1, len(k)-1)
+    dk = k[i] - k[i-1]
+    t = ((rk - k[i-1]) / where(dk > 0, dk, 1)).clip(0, 1)
+    return bnd[1:, i-1] * (1 - t) + bnd[1:, i] * t
+
+# Cell
+def compare_bands(ref, bands, units=THz, nproc=None):
+    '''
+    Compare the phonon dispersions `bands` with the reference `ref`.
+    The arguments are `.bands` file names or the `load_bands` results.
+    The files are read in parallel (see `load_bands_many`).
+
+    Returns the dictionary of arrays of differences (in `units`) with
+    the first index running over the compared `bands`:
+    `rms`, `max` - over all branches and k-points,
+    `branch_rms`, `branch_max` - for every branch,
+    `point_rms`, `point_max` - over branches at every high-symmetry point,
+    and the (labels, positions) of the points under the `points` key.
+    '''
+    if isinstance(ref, (str, os.PathLike)):
+        ref = load_bands(ref)
+    bands = list(bands)
+    fidx = [n for n, b in enumerate(bands) if isinstance(b, (str, os.PathLike))]
+    for n, b in zip(fidx, load_bands_many([bands[n] for n in fidx], nproc)):
+        bands[n] = b
+
+    rbnd, (lbl, pnt) = ref
+    d = (stack([_align_bands(b, kp, ref) for b, kp in bands]) - rbnd[1:]) * un.invcm / units
+    ad = abs(d)
+    # Nearest k-points of the high-symmetry points
+    ip = abs(rbnd[0][:, None] - array(pnt)).argmin(axis=0)
+    return {'rms': sqrt((d**2).mean(axis=(1, 2))), 'max': ad.max(axis=(1, 2)),
+            'branch_rms': sqrt((d**2).mean(axis=2)), 'branch_max': ad.max(axis=2),
+            'point_rms': sqrt((d[:, :, ip]**2).mean(axis=1)), 'point_max': ad[:, :, ip].max(axis=1),
+            'points': (lbl, pnt)}
+
+# Cell
+def print_bands_comparison(res, names=None, file=None):
+    '''
+    Print the results of the `compare_bands` function as a tab-separated
+    table with one row for every compared dispersion and quantity:
+    the total difference, every branch and every high-symmetry point.
+    '''
+    lbl, pnt = res['points']
+    lbl = ['G' if l == '$\\Gamma$' else l for l in lbl]
+    if names is None:
+        names = range(1, len(res['rms']) + 1)
+    print('file\tkind\tid\tk\trms\tmax', file=file)
+    for n, name in enumerate(names):
+        print(f'{name}\ttotal\t-\t-\t{res["rms"][n]:.6g}\t{res["max"][n]:.6g}', file=file)
+        for b, (r, m) in enumerate(zip(res['branch_rms'][n], res['branch_max'][n])):
+            print(f'{name}\tbranch\t{b+1}\t-\t{r:.6g}\t{m:.6g}', file=file)
+        for l, k, r, m in zip(lbl, pnt, res['point_rms'][n], res['point_max'][n]):
+            print(f'{name}\tpoint\t{l}\t{k:.6f}\t{r:.6g}\t{m:.6g}', file=file)
+
+# Cell
+
+def plot_dofmu_stat(cryst, dofmu, skip=10, window=10, ctx=None):
+    '''
+    Plot the history and distribution of the DOF virials. The `dofmu` may be
+    the `dofmu_list` (or `History`) of the sampler or the `VirialAccumulator`
+    filled by the sampler (`dofmu_acc` parameter). In the latter case the block
+    averages of the history are plotted and the `skip` of the accumulator is used.
+    The `skip` is in steps, the `window` in the recorded entries of the history.
+    '''
+    if ctx is None:
+        ctx = get_structure_context(cryst)
+    if isinstance(dofmu, VirialAccumulator):
+        return _plot_dofmu_acc(ctx, dofmu)
     xdof = array(dofmu)
-    skip = min(skip, len(dofmu)//2)
-    window = min(window, len(dofmu)//2)
+    t = dofmu.steps - 1 if isinstance(dofmu, History) else arange(len(xdof))
+    skip = min(skip, (t[-1]+1)//2)
+    sk = searchsorted(t, skip)
+    window = min(window, len(xdof)//2)
 
     figure(figsize=(10,4))
 
-    for i, el in enumerate(set(elmap[1])):
+    for i, el in enumerate(ctx.elements):
         n = len(xdof)
-        elmask = elmap[1]==el
+        elmask = ctx.dofel==el
         semilogy()
-        plot(xdof[:,elmask,:].reshape((-1,3*sum(elmask))),
+        plot(t, xdof[:,elmask,:].reshape((-1,3*sum(elmask))),
                  '.', color=f'C{i}', ms=1, alpha=0.2)
 
         asx = moving_average(xdof[:,elmask,:].mean((-1,-2)), window)
-        plot((n-len(asx))//2+arange(len(asx)), asx, '--',
+        plot(t[(n-len(asx))//2+arange(len(asx))], asx, '--',
                  label=f'{chemical_symbols[el]} (ma, w={window})', color=f'C{i}');
 
         asx = ewma(xdof[:,elmask,:].mean((-1,-2)), window)
-        plot((n-len(asx))//2+arange(len(asx)), asx,
+        plot(t[(n-len(asx))//2+arange(len(asx))], asx,
                  label=f'{chemical_symbols[el]} (ewma, w={window})', color=f'C{i}');
 
     axvspan(0, skip, color='k', alpha=0.2)
@@ -485,9 +952,9 @@ def plot_dofmu_stat(cryst, dofmu, skip=10, window=10):
 
     mi, ma = -1, -1
 
-    for i, el in enumerate(set(elmap[1])):
-        elmask = elmap[1]==el
-        m, s = plot_hist(xdof[skip:,elmask,:].mean((-2, -1)),
+    for i, el in enumerate(ctx.elements):
+        elmask = ctx.dofel==el
+        m, s = plot_hist(xdof[sk:,elmask,:].mean((-2, -1)),
                          chemical_symbols[el], i,)
                          # normal=False, df=3*sum(elmask))
         if mi < 0 or mi > m-3*s:
@@ -503,31 +970,35 @@ def plot_dofmu_stat(cryst, dofmu, skip=10, window=10):
 
 # Cell
 
-def plot_xs_stat(cryst, xsl, skip=10, window=10):
-    symm = get_symmetry_dataset(cryst)
-    dofmap = symm['mapping_to_primitive']
-    dof = set(dofmap)
-    dofmul = Counter(symm['mapping_to_primitive'])
-    elems = dict(zip(symm['std_mapping_to_primitive'],symm['std_types']))
-    elmap = array(sorted(elems.items())).T
-    elmap = cryst.get_atomic_numbers()
-    xdof = array(xsl)
-    skip = min(skip, len(xsl)//2)
-    window = min(window, len(xsl)//2)
+def plot_xs_stat(cryst, xsl, skip=10, window=10, ctx=None):
+    '''
+    Plot the history and distribution of the amplitude correction.
+    The `xsl` may be the `xscale_list` or the `History` of the sampler.
+    The `skip` is in steps, the `window` in the recorded entries of the history.
+    '''
+    if ctx is None:
+        ctx = get_structure_context(cryst)
+    if isinstance(xsl, History):
+        t, xel = xsl.steps - 1, xsl.el_mean()
+    else :
+        xel = ctx.el_mean(array(xsl))
+        t = arange(len(xel))
+    skip = min(skip, (t[-1]+1)//2)
+    sk = searchsorted(t, skip)
+    window = min(window, len(xel)//2)
 
     plt.figure(figsize=(10,4))
 
-    for i, el in enumerate(set(elmap)):
-        n = len(xdof)
-        plot(xdof[:,elmap==el,:].mean((-2,-1)),
-                 '.', color=f'C{i}', ms=2, alpha=0.25)
+    for i, el in enumerate(ctx.elements):
+        n = len(xel)
+        plot(t, xel[:,i], '.', color=f'C{i}', ms=2, alpha=0.25)
 
-        asx = moving_average(xdof[:,elmap==el,:].mean((-1,-2)), window)
-        plot((n-len(asx))//2 + arange(len(asx)), asx, '--',
+        asx = moving_average(xel[:,i], window)
+        plot(t[(n-len(asx))//2 + arange(len(asx))], asx, '--',
                  label=f'{chemical_symbols[el]} (ma, w={window})', color=f'C{i}');
 
-        asx = ewma(xdof[:,elmap==el,:].mean((-1,-2)), window)
-        plot((n-len(asx))//2 + arange(len(asx)), asx,
+        asx = ewma(xel[:,i], window)
+        plot(t[(n-len(asx))//2 + arange(len(asx))], asx,
                  label=f'{chemical_symbols[el]} (ewma, w={window})', color=f'C{i}');
 
     axvspan(0, skip, color='k', alpha=0.2)
@@ -539,9 +1010,8 @@ def plot_xs_stat(cryst, xsl, skip=10, window=10):
     show();
 
     mi, ma = -1, -1
-    for i, el in enumerate(set(elmap)):
-        m, s = plot_hist(xdof[skip:,elmap==el,:].mean((-2,-1)),
-                  chemical_symbols[el], i)
+    for i, el in enumerate(ctx.elements):
+        m, s = plot_hist(xel[sk:,i], chemical_symbols[el], i)
         if mi < 0 or mi > m-3*s:
             mi = m-3*s
         if ma < 0 or ma < m+3*s: